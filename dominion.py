@@ -1,14 +1,89 @@
 #!/usr/bin/python
 
 import sys
+import os
+import time
+import json
+import copy
+import struct
+import mmap
+import array
+import gzip
+import tempfile
+import shutil
 import random
 import logging
 import unittest
 import cmd
 import itertools
+import collections
+import argparse
+import math
+import functools
+import multiprocessing
+import threading
+import socket
+import SocketServer
+import StringIO
+import Queue
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# when False the simulation makes no logging calls and formats no messages; see setTracing
+TRACE = True
+
+def setTracing(enabled):
+    global TRACE
+    TRACE = enabled
+
+class UntracedTest(unittest.TestCase):
+    # a test which plays games without tracing them
+    def setUp(self):
+        setTracing(False)
+
+    def tearDown(self):
+        setTracing(True)
+
+# counters and timings are gathered in this Profile while profiling is on; see setProfiling
+PROFILE = None
+
+def setProfiling(profile):
+    global PROFILE
+    PROFILE = profile
+
+class Profile:
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.times = collections.defaultdict(float)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def addTime(self, name, start):
+        self.times[name] += time.time() - start
+
+    def counted(self, name, items):
+        # pass on the items of a generator, counting them
+        for item in items:
+            self.counts[name] += 1
+            yield item
+
+    def merge(self, other):
+        for name in other.counts:
+            self.counts[name] += other.counts[name]
+        for name in other.times:
+            self.times[name] += other.times[name]
+
+LOGGERS = {}
 
 def log(name, msg, *args):
-    logging.getLogger(name).info(msg, *args)
+    logger = LOGGERS.get(name)
+    if logger is None:
+        logger = LOGGERS[name] = logging.getLogger(name)
+    logger.info(msg, *args)
 
 class Card:
     def __init__(self, cost, cash=0, victory=0, action=None):
@@ -36,6 +111,16 @@ class Action(object):
         self.apply(hand)
         return [hand]
 
+    # apply each way of playing this action to a SearchState in turn, yielding after each one and undoing it
+    # before the next, in the same order as waysToPlayCard; by default there is one way, which changes nothing
+    # the search keeps track of
+    def searchWays(self, state):
+        yield
+
+    # upper bounds on the (cash, cards drawn, actions) which playing this action can add to the hand
+    def bounds(self, hand):
+        return (0, 0, 0)
+
 class PlusActions(Action):
     def __init__(self, actions):
         self.actions = actions
@@ -44,9 +129,17 @@ class PlusActions(Action):
         hand.actions += self.actions
         return [hand]
 
+    def searchWays(self, state):
+        state.actions += self.actions
+        yield
+        state.actions -= self.actions
+
     def describe(self):
         return '+%s action(s)' % self.actions
 
+    def bounds(self, hand):
+        return (0, 0, self.actions)
+
 class PlusCards(Action):
     def __init__(self, draw, replace=0):
         self.draw = draw
@@ -58,6 +151,14 @@ class PlusCards(Action):
             hand.deckActions += ['replace'] * self.replace
         return [hand]
 
+    def searchWays(self, state):
+        if not self.canDraw(state):
+            yield
+            return
+        state.addDeckActions(self.draw, self.replace)
+        yield
+        state.removeDeckActions(self.draw, self.replace)
+
     def describe(self):
         desc = '+%s cards(s)' % self.draw
         if self.replace:
@@ -67,6 +168,9 @@ class PlusCards(Action):
     def canDraw(self, hand):
         return True
 
+    def bounds(self, hand):
+        return (0, max(0, self.draw - self.replace), 0)
+
 class PlusCardsIfNoActions(PlusCards):
     def __init__(self, draw, replace=0):
         PlusCards.__init__(self, draw, replace)
@@ -97,6 +201,11 @@ class PlusBuys(Action):
         hand.buys += self.buys
         return [hand]
 
+    def searchWays(self, state):
+        state.buys += self.buys
+        yield
+        state.buys -= self.buys
+
     def describe(self):
         return '+%s buy(s)' % self.buys
 
@@ -108,27 +217,52 @@ class PlusCash(Action):
         hand.cashOffset += self.cash
         return [hand]
 
+    def searchWays(self, state):
+        state.cashOffset += self.cash
+        yield
+        state.cashOffset -= self.cash
+
     def describe(self):
         return '+$%s' % self.cash
 
+    def bounds(self, hand):
+        return (self.cash, 0, 0)
+
 class DiscardForCash(Action):
-    def waysToPlayCard(self, hand):
+    def choices(self, collated):
         # No point discarding cards already worth a dollar
-        discardChoices = [card for card in hand.hand if CARDS[card].cash < 1]
-        discardChoices.sort() # ensure the tuples are ordered, so we can remove duplicates
-        tuples = []
-        for k in range(len(discardChoices) + 1):
-            tuples += itertools.combinations(discardChoices, k)
-        tuples = set(tuples) # remove duplicates
+        discardable = [i for i in range(NUM_CARDS) if collated[i] and CARD_CASH[i] < 1]
+        # each distinct set of discards is a number of each type of card, so duplicates are never generated
+        choices = list(itertools.product(*[range(collated[i] + 1) for i in discardable]))
+        # fewest discards first, with the option to discard nothing last
+        choices.sort(key=lambda choice: (sum(choice) == 0, sum(choice)))
+        return discardable, choices
+
+    def waysToPlayCard(self, hand):
+        discardable, choices = self.choices(hand.collated)
         hands = []
-        for tup in tuples:
+        for choice in choices:
             h = hand.clone()
-            for card in tup:
-                h.discard(card)
-                h.cashOffset += 1
+            for i, count in zip(discardable, choice):
+                for j in range(count):
+                    h.discard(CARD_NAMES[i])
+            h.cashOffset += sum(choice)
             hands.append(h)
         return hands
 
+    def searchWays(self, state):
+        discardable, choices = self.choices(state.collated)
+        for choice in choices:
+            for i, count in zip(discardable, choice):
+                for j in range(count):
+                    state.discard(i)
+            state.cashOffset += sum(choice)
+            yield
+            state.cashOffset -= sum(choice)
+            for i, count in zip(discardable, choice):
+                for j in range(count):
+                    state.undiscard(i)
+
     def playHuman(self, hand):
         print 'Enter cards to discard separated by space'
         inp = raw_input('> ')
@@ -144,6 +278,9 @@ class DiscardForCash(Action):
     def describe(self):
         return 'Discard any number of cards. +$1 per card discarded.'
 
+    def bounds(self, hand):
+        return (sum(hand.collated[i] for i in range(NUM_CARDS) if CARD_CASH[i] < 1), 0, 0)
+
 class DiscardForCashTest(unittest.TestCase):
     def test_noDiscardableCards(self):
         action = DiscardForCash()
@@ -178,6 +315,12 @@ class DiscardForCashTest(unittest.TestCase):
         hands = action.waysToPlayCard(start)
         self.assertEquals(len(hands), 9)
 
+    def test_oneHandPerNumberOfIdenticalCards(self):
+        action = DiscardForCash()
+        start = Hand(cards=['estate'] * 5 + ['copper'])
+        hands = action.waysToPlayCard(start)
+        self.assertEquals([h.cashOffset for h in hands], [1, 2, 3, 4, 5, 0])
+
 def choose(choices):
     c = 1
     for choice in choices:
@@ -208,6 +351,25 @@ class Choose(Action):
             allHands += hands
         return allHands
 
+    def searchWays(self, state):
+        for tup in itertools.combinations(self.choices, self.k):
+            for way in self.searchChoices(tup, state):
+                yield
+
+    def searchChoices(self, choices, state):
+        # every way of playing each of the choices, one after the other
+        if not choices:
+            yield
+            return
+        for way in choices[0].searchWays(state):
+            for rest in self.searchChoices(choices[1:], state):
+                yield
+
+    def bounds(self, hand):
+        # the best k choices for each of cash, cards and actions, although they may not all be the same choices
+        bounds = [choice.bounds(hand) for choice in self.choices]
+        return tuple(sum(sorted(values, reverse=True)[:self.k]) for values in zip(*bounds))
+
     def describe(self):
         desc = 'Choose %s:' % self.k
         for choice in self.choices:
@@ -297,6 +459,55 @@ class TrashCards(Action):
     def describe(self):
         return 'Trash %s' % self.trash
 
+def actionSteps(action):
+    # every way of playing an action as a list of the simple actions it adds up to, in the order searchWays
+    # plays them, or None if some way depends on more than the hand's action cards (e.g. discarding)
+    if type(action) in (PlusActions, PlusBuys, PlusCash, PlusCards, PlusCardsIfNoActions, TrashCards):
+        return [[action]]
+    elif type(action) is Choose:
+        ways = []
+        for tup in itertools.combinations(action.choices, action.k):
+            choiceWays = [actionSteps(choice) for choice in tup]
+            if None in choiceWays:
+                return None
+            for combination in itertools.product(*choiceWays):
+                ways.append([step for steps in combination for step in steps])
+        return ways
+    return None
+
+def stepsEffect(steps):
+    # the (actions, buys, cash, draw, replace, draw if no actions) effect of playing the steps one after
+    # another, or None when it cannot be told by these alone because a replace is followed by more cards
+    actions = buys = cash = draw = replace = drawIfNoActions = 0
+    for step in steps:
+        if type(step) is PlusActions:
+            actions += step.actions
+        elif type(step) is PlusBuys:
+            buys += step.buys
+        elif type(step) is PlusCash:
+            cash += step.cash
+        elif isinstance(step, PlusCards):
+            # draws are only told apart from each other by replaces, which must come last
+            if replace:
+                return None
+            if type(step) is PlusCardsIfNoActions:
+                if step.replace:
+                    return None
+                drawIfNoActions += step.draw
+            else:
+                draw += step.draw
+                replace += step.replace
+    return (actions, buys, cash, draw, replace, drawIfNoActions)
+
+def compileAction(action):
+    # the effect of each way of playing an action, in the order searchWays plays them, or None if the
+    # action has to be searched by calling it
+    ways = actionSteps(action)
+    if ways is None:
+        return None
+    effects = [stepsEffect(steps) for steps in ways]
+    return None if None in effects else effects
+
 COURTYARD_ACTION = PlusCards(3, replace=1)
 PAWN_ACTION = Choose(k=2, choices=[PlusCards(1), PlusActions(1), PlusBuys(1), PlusCash(1)])
 SECRET_CHAMBER_ACTION = DiscardForCash() # todo: reaction
@@ -323,6 +534,33 @@ CARDS = {
     'nobles': Card(cost=6, victory=2, action=NOBLES_ACTION),
 }
 
+# compiled card registry: each card has a small integer id, which indexes the count vectors held by
+# Deck, Hand and Table and the attribute arrays below; card names remain the public API
+CARD_NAMES = sorted(CARDS)
+CARD_IDS = dict((name, i) for i, name in enumerate(CARD_NAMES))
+NUM_CARDS = len(CARD_NAMES)
+CARD_COST = [CARDS[name].cost for name in CARD_NAMES]
+CARD_CASH = [CARDS[name].cash for name in CARD_NAMES]
+CARD_VICTORY = [CARDS[name].victory for name in CARD_NAMES]
+CARD_HAS_ACTION = [CARDS[name].action is not None for name in CARD_NAMES]
+# ids of the cards which have each attribute, so that sums skip the cards which contribute nothing
+TREASURE_IDS = [i for i in range(NUM_CARDS) if CARD_CASH[i]]
+VICTORY_IDS = [i for i in range(NUM_CARDS) if CARD_VICTORY[i]]
+ACTION_IDS = [i for i in range(NUM_CARDS) if CARD_HAS_ACTION[i]]
+# the compiled effects of each action card, by id, and upper bounds on the (cash, cards drawn, actions)
+# each can add, or None where the action is searched by calling it
+CARD_EFFECTS = [compileAction(CARDS[name].action) if CARDS[name].action else None for name in CARD_NAMES]
+CARD_BOUNDS = [effects and tuple(max(values) for values in zip(*[(cash, draw - replace + drawIfNoActions, actions)
+    for actions, buys, cash, draw, replace, drawIfNoActions in effects])) for effects in CARD_EFFECTS]
+PROVINCE = CARD_IDS['province']
+
+def countVector(cards):
+    # convert a dict of card name to quantity into a count vector
+    counts = [0] * NUM_CARDS
+    for card in cards:
+        counts[CARD_IDS[card]] = cards[card]
+    return counts
+
 VICTORY_COUNT = 8
 ACTION_COUNT = 10
 
@@ -342,21 +580,32 @@ DEFAULT_STACKS = {
     'nobles': VICTORY_COUNT,
 }
 
+# recount the totals which Deck keeps up to date on every query, to check them
+CHECK_DECK_TOTALS = False
+
 class Deck:
-    def __init__(self, cards={'copper': 7, 'estate': 3}):
+    def __init__(self, cards={'copper': 7, 'estate': 3}, rng=random):
+        # source of randomness for shuffling; games played with a seed have their own generator
+        self.rng = rng
         deck = []
         for card in cards:
             quantity = cards[card]
             for i in range(quantity):
                 deck.append(card)
-        random.shuffle(deck)
+        rng.shuffle(deck)
         # cards which are waiting to be dealt
         self.deck = deck
         # cards which have been discarded
         self.discards = []
-        # count of each card type, including the deck, discards, and those in play
+        # count of each card type by id, including the deck, discards, and those in play
         # (cards being played in the current hand are not included in deck or discards)
-        self.cards = dict(cards)
+        self.cards = countVector(cards)
+        # running totals over self.cards, kept up to date by gain and trash
+        self.total = 0
+        self.totalCash = 0
+        self.totalVictory = 0
+        for card in cards:
+            self.addTotals(CARD_IDS[card], cards[card])
 
     def draw(self):
         if not self.deck:
@@ -379,50 +628,94 @@ class Deck:
 
     # gain a new card, onto the discard pile
     def gain(self, card):
-        if card in self.cards:
-            self.cards[card] += 1
-        else:
-            self.cards[card] = 1
+        i = CARD_IDS[card]
+        self.cards[i] += 1
+        self.addTotals(i, 1)
         self.discards.append(card)
 
+    # remove a card in play from the deck for good
+    def trash(self, card):
+        i = CARD_IDS[card]
+        assert self.cards[i] > 0
+        self.cards[i] -= 1
+        self.addTotals(i, -1)
+
+    def addTotals(self, i, quantity):
+        self.total += quantity
+        self.totalCash += CARD_CASH[i] * quantity
+        self.totalVictory += CARD_VICTORY[i] * quantity
+
     def discard(self, card):
         self.discards.append(card)
 
     def shuffle(self):
-        self.deck = self.deck + self.discards
-        self.discards = []
-        random.shuffle(self.deck)
+        if PROFILE: PROFILE.count('shuffles')
+        deck = self.deck
+        if deck:
+            deck.extend(self.discards)
+            del self.discards[:]
+        else:
+            # the discards become the deck, and the empty deck's list takes the next discards
+            self.deck, self.discards = self.discards, deck
+        self.rng.shuffle(self.deck)
 
     def count(self, card):
-        if card in self.cards:
-            return self.cards[card]
-        else:
-            return 0
+        return self.cards[CARD_IDS[card]] if card in CARD_IDS else 0
 
     def size(self):
-        total = 0
-        for card in self.cards:
-            total += self.cards[card]
-        return total
+        if CHECK_DECK_TOTALS: self.checkTotals()
+        return self.total
 
     def countVictory(self):
-        victory = 0
-        for card in self.cards:
-            victory += CARDS[card].victory * self.cards[card]
-        return victory
+        if CHECK_DECK_TOTALS: self.checkTotals()
+        return self.totalVictory
 
     def expectedCash(self):
-        count = 0
-        cash = 0.0
-        for c in self.cards:
-            count += self.cards[c]
-            cash += CARDS[c].cash * self.cards[c]
-        if count == 0:
+        if CHECK_DECK_TOTALS: self.checkTotals()
+        if self.total == 0:
             return 0
         else:
-            return cash / count
+            return float(self.totalCash) / self.total
+
+    def copy(self, rng):
+        # a copy with its own generator, for playing on from the same position
+        deck = copy.copy(self)
+        deck.rng = rng
+        deck.deck = list(self.deck)
+        deck.discards = list(self.discards)
+        deck.cards = list(self.cards)
+        return deck
+
+    def snapshot(self):
+        # the order of the deck and discards, and what the deck holds, as immutable tuples
+        return (tuple(self.deck), tuple(self.discards), tuple(self.cards), self.total, self.totalCash,
+            self.totalVictory)
+
+    def restore(self, snapshot):
+        deck, discards, cards, self.total, self.totalCash, self.totalVictory = snapshot
+        self.deck[:] = deck
+        self.discards[:] = discards
+        self.cards[:] = cards
+
+    def checkTotals(self):
+        # recount the running totals from scratch
+        cards = self.cards
+        assert self.total == sum(cards), 'Deck size %s, expected %s' % (self.total, sum(cards))
+        cash = sum(CARD_CASH[i] * cards[i] for i in TREASURE_IDS)
+        assert self.totalCash == cash, 'Deck cash %s, expected %s' % (self.totalCash, cash)
+        victory = sum(CARD_VICTORY[i] * cards[i] for i in VICTORY_IDS)
+        assert self.totalVictory == victory, 'Deck victory %s, expected %s' % (self.totalVictory, victory)
 
 class DeckTest(unittest.TestCase):
+    def test_shuffleReusesLists(self):
+        deck = Deck({'copper': 3, 'estate': 2}, random.Random(1))
+        lists = set([id(deck.deck), id(deck.discards)])
+        for i in range(20):
+            card = deck.draw()
+            deck.discard(card)
+            self.assertEqual(set([id(deck.deck), id(deck.discards)]), lists)
+        self.assertEqual(sorted(deck.deck + deck.discards), ['copper'] * 3 + ['estate'] * 2)
+
     def test_expectedCash(self):
         deck = Deck({'copper': 3})
         self.assertEqual(deck.expectedCash(), 1)
@@ -433,6 +726,90 @@ class DeckTest(unittest.TestCase):
         deck = Deck({'copper': 2, 'gold': 2, 'estate': 4})
         self.assertEqual(deck.expectedCash(), 1)
 
+    def test_totalsFollowGainAndTrash(self):
+        global CHECK_DECK_TOTALS
+        CHECK_DECK_TOTALS = True
+        try:
+            deck = Deck({'copper': 7, 'estate': 3})
+            deck.gain('gold')
+            deck.gain('province')
+            deck.trash('estate')
+            deck.trash('copper')
+            self.assertEqual(deck.size(), 10)
+            self.assertEqual(deck.countVictory(), 8)
+            self.assertAlmostEqual(deck.expectedCash(), 0.9)
+        finally:
+            CHECK_DECK_TOTALS = False
+
+    def test_trashedCardsLeaveTheDeck(self):
+        deck = Deck({'copper': 3, 'estate': 2})
+        hand = Hand(cards=['copper', 'estate'])
+        hand.trash('estate')
+        hand.finish(deck)
+        self.assertEqual(deck.count('estate'), 1)
+        self.assertEqual(deck.size(), 4)
+
+class LRUCache:
+    # bounded cache, discarding the least recently used entry when full
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        # re-insert to mark as most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        if len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def describeLookups(self):
+        return '%s hits in %s lookups (%.1f%%)' % (self.hits, self.hits + self.misses, 100 * self.hitRate())
+
+    def describe(self):
+        return '%s, %s entries' % (self.describeLookups(), len(self.entries))
+
+# results of Hand.waysToPlayHand and HandSearch, shared by all hands
+TRANSPOSITIONS = LRUCache()
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evictsLeastRecentlyUsed(self):
+        table = LRUCache(size=2)
+        table.put('a', 1)
+        table.put('b', 2)
+        self.assertEqual(table.get('a'), 1)
+        table.put('c', 3)
+        self.assertEqual(table.get('b'), None)
+        self.assertEqual(table.get('a'), 1)
+        self.assertEqual(table.get('c'), 3)
+        self.assertEqual((table.hits, table.misses), (3, 1))
+
+def scaledCash(cash, drawn, deck):
+    # expected cash multiplied by the size of the deck, which keeps it a whole number so it compares exactly
+    if deck.total == 0:
+        return cash
+    return cash * deck.total + drawn * deck.totalCash
+
 class Hand:
     def __init__(self, deck=None, sourceHand=None, cards=[]):
         if sourceHand:
@@ -444,12 +821,15 @@ class Hand:
             self.cashOffset = sourceHand.cashOffset
             self.deckActions = list(sourceHand.deckActions)
             self.discarded = list(sourceHand.discarded)
+            self.trashed = list(sourceHand.trashed)
+            self.collated = list(sourceHand.collated)
+            return
         else:
             if deck:
                 self.hand = deck.deal(5)
-                log('hand', 'Dealt hand: %s', self.hand)
+                if TRACE: log('hand', 'Dealt hand: %s', self.hand)
             else:
-                # This mode is for testing
+                # a hand of the given cards, for testing and for the human player
                 self.hand = cards
             self.played = []
             self.actions = 1;
@@ -457,6 +837,7 @@ class Hand:
             self.cashOffset = 0;
             self.deckActions = []
             self.discarded = []
+            self.trashed = []
         self.collateCards()
 
     def __repr__(self):
@@ -469,51 +850,54 @@ class Hand:
             self.discarded == other.discarded
 
     def clone(self):
+        if PROFILE: PROFILE.count('hand clones')
         return Hand(sourceHand=self)
 
     def collateCards(self):
-        self.collated = {}
+        # count of each card type in hand, by id
+        self.collated = [0] * NUM_CARDS
         for card in self.hand:
-            if card in self.collated:
-                self.collated[card] += 1
-            else:
-                self.collated[card] = 1
+            self.collated[CARD_IDS[card]] += 1
 
     def countCash(self):
+        collated = self.collated
         cash = self.cashOffset
-        for card in self.collated:
-            cash += self.collated[card] * CARDS[card].cash
+        for i in TREASURE_IDS:
+            cash += collated[i] * CARD_CASH[i]
         return cash
 
     def countActions(self):
+        collated = self.collated
         actions = 0
-        for card in self.collated:
-            if CARDS[card].action:
-                actions += self.collated[card]
+        for i in ACTION_IDS:
+            actions += collated[i]
         return actions
 
     def getActions(self):
-        return [card for card in self.collated if CARDS[card].action]
+        return [CARD_NAMES[i] for i in ACTION_IDS if self.collated[i]]
 
     def count(self, card):
-        if card in self.collated:
-            return self.collated[card]
-        else:
-            return 0
+        return self.collated[CARD_IDS[card]] if card in CARD_IDS else 0
 
     def play(self, card):
         self.hand.remove(card)
-        self.collated[card] -= 1
+        self.collated[CARD_IDS[card]] -= 1
         self.played.append(card)
 
     def discard(self, card):
         self.hand.remove(card)
-        self.collated[card] -= 1
+        self.collated[CARD_IDS[card]] -= 1
         self.discarded.append(card)
 
     def trash(self, card):
         self.hand.remove(card)
-        self.collated[card] -= 1
+        self.collated[CARD_IDS[card]] -= 1
+        self.trashed.append(card)
+
+    def trashCards(self, deck):
+        for card in self.trashed:
+            deck.trash(card)
+        self.trashed = []
 
     def discardHand(self):
         cards = list(self.hand)
@@ -522,12 +906,13 @@ class Hand:
 
     def draw(self, deck, count):
         cards = deck.deal(count)
-        log('hand', 'Drew: %s', cards)
+        if TRACE: log('hand', 'Drew: %s', cards)
         self.hand += cards
         self.collateCards()
 
     def finish(self, deck):
         self.discardHand()
+        self.trashCards(deck)
         for card in self.discarded + self.played:
             deck.discard(card)
         self.discarded = []
@@ -538,27 +923,76 @@ class Hand:
         self.deckActions = []
 
     def choices(self):
-        return [card for card in self.collated if self.collated[card] > 0]
+        return [CARD_NAMES[i] for i in range(NUM_CARDS) if self.collated[i] > 0]
+
+    def searchKey(self):
+        # the search only depends on the cards in hand and the actions left: buys, cash and deck actions are
+        # only ever added to, so results are stored relative to them and can be shared between more hands
+        return (tuple(self.collated), self.actions)
 
     def waysToPlayHand(self):
         if self.actions == 0 or self.countActions() == 0:
             return [self]
+        key = self.searchKey()
+        outcomes = TRANSPOSITIONS.get(key)
+        if outcomes is None:
+            outcomes = self.outcomes(self.searchWaysToPlayHand())
+            TRANSPOSITIONS.put(key, outcomes)
+        return [self.applyOutcome(outcome) for outcome in outcomes]
+
+    def outcomes(self, hands):
+        # describe each hand by what was done to reach it from this one, dropping hands which end up
+        # in the same state as an earlier one (e.g. pawn then great-hall, and great-hall then pawn)
+        outcomes = []
+        seen = set()
+        for hand in hands:
+            if hand is self:
+                # the option to do nothing
+                outcomes.append(None)
+                continue
+            played = tuple(hand.played[len(self.played):])
+            discarded = tuple(hand.discarded[len(self.discarded):])
+            deckActions = tuple(hand.deckActions[len(self.deckActions):])
+            buys = hand.buys - self.buys
+            cash = hand.cashOffset - self.cashOffset
+            state = (tuple(sorted(played)), tuple(sorted(discarded)), hand.actions, buys, cash, deckActions)
+            if state in seen:
+                continue
+            seen.add(state)
+            outcomes.append((played, discarded, hand.actions, buys, cash, deckActions))
+        return outcomes
+
+    def applyOutcome(self, outcome):
+        if outcome is None:
+            return self
+        played, discarded, actions, buys, cash, deckActions = outcome
+        hand = self.clone()
+        for card in played:
+            hand.play(card)
+        for card in discarded:
+            hand.discard(card)
+        hand.actions = actions
+        hand.buys += buys
+        hand.cashOffset += cash
+        hand.deckActions += deckActions
+        return hand
+
+    def searchWaysToPlayHand(self):
         # we have an action to use, and a card to play it with
         results = []
-        for c in self.collated:
-            if self.collated[c] == 0:
+        for i in ACTION_IDS:
+            if self.collated[i] == 0:
                 continue
-            card = CARDS[c]
-            if card.action:
-                hand = self.clone()
-                hand.play(c)
-                hand.actions -= 1
-                # list of possible hands resulting from playing the card in different ways
-                possibleHands = card.waysToPlayCard(hand)
-                # now play more hands
-                for possibleHand in possibleHands:
-                    # continue to play more actions if there are any
-                    results += possibleHand.waysToPlayHand()
+            c = CARD_NAMES[i]
+            hand = self.clone()
+            hand.play(c)
+            hand.actions -= 1
+            # list of possible hands resulting from playing the card in different ways
+            possibleHands = CARDS[c].waysToPlayCard(hand)
+            # now play more hands
+            for possibleHand in possibleHands:
+                # continue to play more actions if there are any
+                results += possibleHand.waysToPlayHand()
 
         # there is always the option to do nothing
         results.append(self)
@@ -571,10 +1005,14 @@ class Hand:
         # could be smarter by replacing victory-only cards and counting cash value of all drawn cards
         return self.countCash() + self.drawnCards() * deck.expectedCash()
 
+    def scaledCash(self, deck):
+        return scaledCash(self.countCash(), self.drawnCards(), deck)
+
     def performDeckActions(self, deck, cardToReplace):
         for card in self.discarded:
             deck.discard(card)
         self.discarded = []
+        self.trashCards(deck)
         for action in self.deckActions:
             if action == 'draw':
                 self.draw(deck, 1)
@@ -586,6 +1024,9 @@ class Hand:
         self.deckActions = []
 
 class HandTest(unittest.TestCase):
+    def setUp(self):
+        TRANSPOSITIONS.clear()
+
     def test_bestHand(self):
         deck = Deck({'copper': 3, 'nobles': 2})
         hand = Hand(deck)
@@ -595,75 +1036,406 @@ class HandTest(unittest.TestCase):
         self.assertEqual(best.actions, 1)
         self.assertEqual(best.drawnCards(), 3)
 
+    def test_transposedPlaysAreCollapsed(self):
+        hand = Hand(cards=['pawn', 'great-hall', 'copper'])
+        hands = hand.waysToPlayHand()
+        states = [(sorted(h.hand), sorted(h.played), h.actions, h.buys, h.cashOffset, h.deckActions) for h in hands]
+        for state in states:
+            self.assertEqual(states.count(state), 1)
+
+    def test_cachedResultsMatch(self):
+        hand = Hand(cards=['pawn', 'pawn', 'shanty-town', 'secret-chamber', 'estate'])
+        first = hand.waysToPlayHand()
+        hits = TRANSPOSITIONS.hits
+        second = hand.clone().waysToPlayHand()
+        self.assertEqual(TRANSPOSITIONS.hits, hits + 1)
+        self.assertEqual(first[:-1], second[:-1])
+
 class Table:
     def __init__(self, stacks = DEFAULT_STACKS):
-        self.stacks = dict(stacks)
+        # number of cards left in each stack, by id
+        self.stacks = countVector(stacks)
+        # ids of the cards which are part of this game's supply
+        self.supply = [CARD_IDS[card] for card in stacks]
+        # names of the cards left to buy, and the number of supply stacks which have run out, kept up to
+        # date by buy so that neither depends on the size of the supply
+        self.available = set(CARD_NAMES[i] for i in self.supply if self.stacks[i] > 0)
+        self.depleted = len(self.supply) - len(self.available)
 
     def isGameEnd(self):
-        if not 'province' in self.stacks or self.stacks['province'] == 0: return True
-        depleted = 0
-        for card in self.stacks:
-            if self.stacks[card] == 0:
-                depleted += 1
-                if depleted == 2:
-                    return True
-        return False
+        return self.stacks[PROVINCE] == 0 or self.depleted >= 2
 
     def count(self, card):
-        if not card in self.stacks:
-            return 0
-        else:
-            return self.stacks[card]
+        return self.stacks[CARD_IDS[card]] if card in CARD_IDS else 0
 
     def buy(self, card, deck):
-        assert self.count(card) > 0
-        self.stacks[card] -= 1
+        i = CARD_IDS[card]
+        assert self.stacks[i] > 0
+        self.stacks[i] -= 1
+        if self.stacks[i] == 0:
+            self.available.discard(card)
+            self.depleted += 1
         deck.gain(card)
 
     def availableCards(self):
-        return [k for k in self.stacks if self.stacks[k] > 0]
+        # a frozen copy for callers outside the simulation, such as tab-completion, since the live set must only
+        # change along with the stacks; the simulation reads self.available instead
+        return frozenset(self.available)
+
+    def copy(self):
+        table = copy.copy(self)
+        table.stacks = list(self.stacks)
+        table.available = set(self.available)
+        return table
+
+    def snapshot(self):
+        return tuple(self.stacks)
+
+    def restore(self, snapshot):
+        self.stacks[:] = snapshot
+        self.available = set(CARD_NAMES[i] for i in self.supply if self.stacks[i] > 0)
+        self.depleted = len(self.supply) - len(self.available)
+
+class TableTest(unittest.TestCase):
+    def test_onlySupplyStacksCountAsDepleted(self):
+        table = Table({'province': 1, 'copper': 0})
+        self.assertFalse(table.isGameEnd())
+        self.assertEqual(table.availableCards(), set(['province']))
+        self.assertEqual(table.count('gold'), 0)
+
+        table = Table({'province': 1, 'copper': 0, 'estate': 1})
+        table.buy('estate', Deck())
+        self.assertTrue(table.isGameEnd())
+
+    def test_runningCountsMatchStacks(self):
+        # a kingdom of every card, bought from until the game ends
+        rng = random.Random(1)
+        table = Table(dict((c, 3) for c in CARD_NAMES))
+        deck = Deck()
+        while not table.isGameEnd():
+            table.buy(rng.choice(sorted(table.availableCards())), deck)
+            available = set(CARD_NAMES[i] for i in table.supply if table.stacks[i] > 0)
+            self.assertEqual(table.availableCards(), available)
+            self.assertEqual(table.depleted, NUM_CARDS - len(available))
+        # changing the cards returned does not change the table
+        self.assertRaises(AttributeError, lambda: table.availableCards().add('province'))
+        self.assertTrue(table.stacks[PROVINCE] == 0 or table.depleted == 2)
 
 def bestHand(hands, deck):
     best = None
+    bestCash = 0
     for hand in hands:
+        cash = hand.scaledCash(deck)
         if not best:
             best = hand
-        elif hand.expectedCash(deck) > best.expectedCash(deck):
+            bestCash = cash
+        elif cash > bestCash:
             best = hand
-        elif hand.expectedCash(deck) == best.expectedCash(deck) and hand.actions > best.actions:
+            bestCash = cash
+        elif cash == bestCash and hand.actions > best.actions:
             best = hand
     return best
 
+class SearchState(object):
+    # a hand being searched, which plays are applied to in place and undone on the way back
+    #
+    # Only what the search needs is kept: counts of the cards left in hand, and stacks of the cards played,
+    # the cards discarded and the deck actions, which are pushed by each play and popped again to undo it.
+    __slots__ = ('start', 'collated', 'actions', 'buys', 'cashOffset', 'drawn', 'played', 'discarded',
+        'deckActions')
+
+    def __init__(self, hand):
+        self.start = hand
+        self.collated = list(hand.collated)
+        self.actions = hand.actions
+        self.buys = hand.buys
+        self.cashOffset = hand.cashOffset
+        self.drawn = hand.drawnCards()
+        # card ids played and discarded, and deck actions added, since the start
+        self.played = []
+        self.discarded = []
+        self.deckActions = []
+
+    def play(self, i):
+        self.collated[i] -= 1
+        self.played.append(i)
+        self.actions -= 1
+
+    def unplay(self, i):
+        self.actions += 1
+        self.played.pop()
+        self.collated[i] += 1
+
+    def discard(self, i):
+        self.collated[i] -= 1
+        self.discarded.append(i)
+
+    def undiscard(self, i):
+        self.discarded.pop()
+        self.collated[i] += 1
+
+    def addDeckActions(self, draw, replace):
+        self.deckActions += ['draw'] * draw + ['replace'] * replace
+        self.drawn += draw - replace
+
+    def removeDeckActions(self, draw, replace):
+        del self.deckActions[len(self.deckActions) - draw - replace:]
+        self.drawn -= draw - replace
+
+    def applyEffect(self, effect):
+        # apply a compiled effect, returning the cards it draws for undoEffect
+        actions, buys, cash, draw, replace, drawIfNoActions = effect
+        if drawIfNoActions and self.countActions() == 0:
+            draw += drawIfNoActions
+        self.actions += actions
+        self.buys += buys
+        self.cashOffset += cash
+        self.addDeckActions(draw, replace)
+        return draw
+
+    def undoEffect(self, effect, draw):
+        actions, buys, cash, ignored, replace, drawIfNoActions = effect
+        self.removeDeckActions(draw, replace)
+        self.cashOffset -= cash
+        self.buys -= buys
+        self.actions -= actions
+
+    def countCash(self):
+        collated = self.collated
+        cash = self.cashOffset
+        for i in TREASURE_IDS:
+            cash += collated[i] * CARD_CASH[i]
+        return cash
+
+    def countActions(self):
+        collated = self.collated
+        actions = 0
+        for i in ACTION_IDS:
+            actions += collated[i]
+        return actions
+
+    def scaledCash(self, deck):
+        return scaledCash(self.countCash(), self.drawn, deck)
+
+    def outcome(self):
+        # what has been done since the start, as Hand.applyOutcome takes it (None if nothing has been played)
+        if not self.played:
+            return None
+        start = self.start
+        return (tuple(CARD_NAMES[i] for i in self.played), tuple(CARD_NAMES[i] for i in self.discarded),
+            self.actions, self.buys - start.buys, self.cashOffset - start.cashOffset, tuple(self.deckActions))
+
+class HandSearch:
+    # branch-and-bound search for the hand which bestHand would choose from waysToPlayHand
+    #
+    # Hands are generated one at a time in the same order as waysToPlayHand, while the best so far is kept.
+    # A branch is pruned when an optimistic bound on what it could reach cannot beat the best hand, or when
+    # a hand already searched holds the same cards with at least as much cash, cards drawn and actions:
+    # in both cases nothing in the branch could replace the best hand, so the decision is unchanged.
+    # Hands are searched as a single SearchState, and only the best is turned back into a Hand.
+    def __init__(self, deck):
+        self.deck = deck
+
+    def search(self, hand):
+        # the best outcome only depends on the hand's search key and the deck's totals: the cash and cards
+        # already drawn add the same to every outcome, so do not change which is best
+        key = (hand.searchKey(), self.deck.total, self.deck.totalCash)
+        best = TRANSPOSITIONS.get(key)
+        if best is None:
+            best = (self.searchOutcome(hand),)
+            TRANSPOSITIONS.put(key, best)
+        return hand.applyOutcome(best[0])
+
+    def searchOutcome(self, hand):
+        # the best outcome so far, with its scaled cash and actions
+        self.found = False
+        self.best = None
+        self.bestCash = 0
+        self.bestActions = 0
+        # (cashOffset, cards drawn, actions) of the hands searched so far, by the cards left in hand
+        self.searched = {}
+        state = SearchState(hand)
+        candidates = self.waysToPlayHand(state)
+        if PROFILE:
+            candidates = PROFILE.counted('candidate hands', candidates)
+        for s in candidates:
+            cash = state.scaledCash(self.deck)
+            if not self.found or cash > self.bestCash or (cash == self.bestCash and state.actions > self.bestActions):
+                self.found = True
+                self.best = state.outcome()
+                self.bestCash = cash
+                self.bestActions = state.actions
+        return self.best
+
+    def waysToPlayHand(self, state):
+        # yields the state once for each way of playing it, as it is after that way
+        if state.actions == 0 or state.countActions() == 0:
+            yield state
+            return
+        if self.isPruned(state):
+            return
+        for i in ACTION_IDS:
+            if state.collated[i] == 0:
+                continue
+            state.play(i)
+            effects = CARD_EFFECTS[i]
+            if effects is None:
+                for way in CARDS[CARD_NAMES[i]].action.searchWays(state):
+                    for result in self.waysToPlayHand(state):
+                        yield result
+            else:
+                for effect in effects:
+                    draw = state.applyEffect(effect)
+                    for result in self.waysToPlayHand(state):
+                        yield result
+                    state.undoEffect(effect, draw)
+            state.unplay(i)
+        yield state
+
+    def isPruned(self, state):
+        if self.found:
+            cash = state.countCash()
+            drawn = state.drawn
+            actions = state.actions
+            for i in ACTION_IDS:
+                count = state.collated[i]
+                if count:
+                    plusCash, draw, plusActions = CARD_BOUNDS[i] or CARDS[CARD_NAMES[i]].action.bounds(state)
+                    cash += count * plusCash
+                    drawn += count * draw
+                    actions += count * max(0, plusActions - 1)
+            cash = scaledCash(cash, drawn, self.deck)
+            if cash < self.bestCash or (cash == self.bestCash and actions <= self.bestActions):
+                return True
+        key = (state.cashOffset, state.drawn, state.actions)
+        searched = self.searched.setdefault(tuple(state.collated), [])
+        for other in searched:
+            if other[0] >= key[0] and other[1] >= key[1] and other[2] >= key[2]:
+                return True
+        searched.append(key)
+        return False
+
+class HandSearchTest(unittest.TestCase):
+    def test_sameDecisionAsBestHand(self):
+        rng = random.Random(1)
+        cards = [c for c in CARDS if c != 'copper'] + ['copper'] * 3
+        for i in range(200):
+            deck = Deck(dict((c, rng.randint(0, 3)) for c in CARDS))
+            hand = Hand(cards=[rng.choice(cards) for j in range(rng.randint(3, 7))])
+            expected = bestHand(hand.waysToPlayHand(), deck)
+            self.assertEqual(HandSearch(deck).search(hand), expected)
+
+    def test_searchesAreShared(self):
+        TRANSPOSITIONS.clear()
+        deck = Deck({'copper': 7, 'silver': 3, 'estate': 3})
+        hand = Hand(cards=['pawn', 'nobles', 'shanty-town', 'copper'])
+        first = HandSearch(deck).search(hand)
+        # cash already added to the hand does not change the decision, so the search is not repeated
+        other = hand.clone()
+        other.cashOffset += 2
+        second = HandSearch(deck).search(other)
+        self.assertEqual(TRANSPOSITIONS.hits, 1)
+        self.assertEqual(second.played, first.played)
+        self.assertEqual(second.cashOffset, first.cashOffset + 2)
+        self.assertEqual(second, bestHand(other.waysToPlayHand(), deck))
+
+    def test_searchAgain(self):
+        TRANSPOSITIONS.clear()
+        deck = Deck({'copper': 7, 'silver': 3, 'estate': 3})
+        search = HandSearch(deck)
+        search.search(Hand(cards=['nobles', 'pawn', 'copper']))
+        hand = Hand(cards=['great-hall', 'estate', 'copper'])
+        self.assertEqual(search.search(hand), bestHand(hand.waysToPlayHand(), deck))
+
+    def test_searchWaysMatchWaysToPlayCard(self):
+        rng = random.Random(2)
+        for i in range(100):
+            hand = Hand(cards=[rng.choice(CARD_NAMES) for j in range(rng.randint(1, 7))])
+            for c in hand.getActions():
+                h = hand.clone()
+                h.play(c)
+                h.actions -= 1
+                expected = CARDS[c].waysToPlayCard(h)
+                state = SearchState(hand)
+                state.play(CARD_IDS[c])
+                ways = [hand.applyOutcome(state.outcome()) for way in CARDS[c].action.searchWays(state)]
+                self.assertEqual(ways, expected)
+                effects = CARD_EFFECTS[CARD_IDS[c]]
+                if effects is not None:
+                    # the compiled effects lead to the same hands, in the same order
+                    compiled = []
+                    for effect in effects:
+                        draw = state.applyEffect(effect)
+                        compiled.append(hand.applyOutcome(state.outcome()))
+                        state.undoEffect(effect, draw)
+                    self.assertEqual(compiled, expected)
+                # everything is undone afterwards
+                state.unplay(CARD_IDS[c])
+                self.assertEqual((state.collated, state.actions, state.cashOffset, state.deckActions, state.discarded),
+                    (hand.collated, hand.actions, hand.cashOffset, [], []))
+
+MAX_COST = max(CARD_COST)
+
+def buyPolicies(buyOrder, prefs):
+    # for each amount of cash up to the cost of the dearest card, the cards which can be bought, grouped by
+    # preference with the most preferred first; each group keeps the chromosome's order, which ties are chosen by
+    policies = []
+    for cash in range(MAX_COST + 1):
+        groups = collections.defaultdict(list)
+        for c in buyOrder:
+            if CARD_COST[c] <= cash:
+                groups[prefs[c]].append(c)
+        policies.append([groups[pref] for pref in sorted(groups, reverse=True)])
+    return policies
+
 class Player:
-    def __init__(self, table, cardPrefs):
+    def __init__(self, table, cardPrefs, rng=random):
         self.table = table
-        self.deck = Deck()
+        self.rng = rng
+        self.deck = Deck(rng=rng)
         self.cardPrefs = cardPrefs
-        self.delays = {}
+        # ids of the cards to consider buying, in the order the chromosome lists them
+        self.buyOrder = [CARD_IDS[card] for card in cardPrefs]
+        # preference and remaining delay for each card, by id
+        self.prefs = [0] * NUM_CARDS
+        self.delays = [0] * NUM_CARDS
         for card in cardPrefs:
-            self.delays[card] = cardPrefs[card][1]
+            self.prefs[CARD_IDS[card]] = cardPrefs[card][0]
+            self.delays[CARD_IDS[card]] = cardPrefs[card][1]
+        # number of cards whose delay has not run out yet
+        self.delayed = sum(1 for c in self.buyOrder if self.delays[c] > 0)
+        self.policies = buyPolicies(self.buyOrder, self.prefs)
+        # when recording, a list to append (dealt, played, bought) card ids to after each hand
+        self.turns = None
 
     def playHand(self, buy=True):
         hand = Hand(self.deck)
+        if self.turns is not None: dealt = [CARD_IDS[c] for c in hand.hand]
+        if PROFILE: start = time.time()
         hand = self.playActions(hand)
+        if PROFILE: PROFILE.addTime('action search', start)
         cash = hand.countCash()
+        bought = None
         if buy:
-            self.playBuys(hand)
+            if PROFILE: start = time.time()
+            bought = self.playBuys(hand)
+            if PROFILE: PROFILE.addTime('buy decisions', start)
+        if self.turns is not None:
+            self.turns.append((dealt, [CARD_IDS[c] for c in hand.played], [CARD_IDS[bought]] if bought else []))
         hand.finish(self.deck)
         return cash
 
     def playActions(self, hand):
         # this is too eager - it plays several actions without determining the outcome (cards drawn) after the first
         while hand.actions > 0 and hand.countActions() > 0:
-            results = hand.waysToPlayHand()
-            best = bestHand(results, self.deck)
+            best = HandSearch(self.deck).search(hand)
             if best == hand:
-                log('play', 'No further actions')
+                if TRACE: log('play', 'No further actions')
                 return hand
             else:
-                log('play', 'Played hand: %r' % hand)
-                hand.performDeckActions(self.deck, self.cardToReplace)
                 hand = best
+                if TRACE: log('play', 'Played hand: %r', hand)
+                hand.performDeckActions(self.deck, self.cardToReplace)
         return hand
 
     def cardToReplace(self, hand):
@@ -689,43 +1461,68 @@ class Player:
         return lowest
 
     def playBuys(self, hand):
+        # returns the card bought, if any
         cash = hand.countCash()
         if cash == 0: return
-        log('buy', 'Cash: %s' % cash)
-        bestCards = []
-        for c in self.cardPrefs:
-            card = CARDS[c]
-            if card.cost > cash: continue
-            if self.table.count(c) == 0: continue
-            if self.delays[c] > 0:
-                self.delays[c] -= 1
-                continue
-
-            if not bestCards or self.compareCards(c, bestCards[0]) > 0:
-                bestCards = [c]
-            elif self.compareCards(bestCards[0], c) == 0:
-                # several cards are equally good, choose randomly
-                bestCards.append(c)
-
+        if TRACE: log('buy', 'Cash: %s', cash)
+        bestCards = self.bestCards(cash)
         if bestCards:
-            c = random.choice(bestCards)
-            log('buy', 'Buying %s', c)
-            self.table.buy(c, self.deck)
-            hand.buys -= 1
-        else:
+            return self.buyCard(hand, CARD_NAMES[self.rng.choice(bestCards)])
+        elif TRACE:
             log('buy', 'No buy')
 
-    def compareCards(self, card1, card2):
-        pref1 = self.pref(card1)
-        pref2 = self.pref(card2)
-        if pref1 != pref2:
-            return pref1 - pref2
-        else:
-            # cards are equally preferred, choose the one we have fewer of (note sign reversal)
-            return self.deck.count(card2) - self.deck.count(card1)
-
-    def pref(self, card):
-        return self.cardPrefs[card][0] if card in self.cardPrefs else 0
+    def bestCards(self, cash):
+        # the ids of the cards the chromosome would buy with this much cash, counting down delays as it goes
+        stacks = self.table.stacks
+        cards = self.deck.cards
+        delays = self.delays
+        bestCards = []
+        for group in self.policies[min(cash, MAX_COST)]:
+            if bestCards and not self.delayed:
+                break
+            fewest = None
+            for c in group:
+                if stacks[c] == 0: continue
+                if delays[c] > 0:
+                    # affordable cards count down their delay, even when something more preferred is bought
+                    delays[c] -= 1
+                    if delays[c] == 0: self.delayed -= 1
+                    continue
+                if bestCards and fewest is None:
+                    # a more preferred card has already been found
+                    continue
+                # among equally preferred cards, choose the one we have fewer of
+                if fewest is None or cards[c] < fewest:
+                    bestCards = [c]
+                    fewest = cards[c]
+                elif cards[c] == fewest:
+                    # several cards are equally good, choose randomly
+                    bestCards.append(c)
+        return bestCards
+
+    def buyCard(self, hand, c):
+        if TRACE: log('buy', 'Buying %s', c)
+        self.table.buy(c, self.deck)
+        hand.buys -= 1
+        return c
+
+    def copy(self, table, rng):
+        # a plain Player with the same chromosome, which plays on from the same position, on the given table
+        # and with its own generator
+        player = Player(table, self.cardPrefs, rng)
+        player.deck = self.deck.copy(rng)
+        player.delays[:] = self.delays
+        player.delayed = self.delayed
+        return player
+
+    def snapshot(self):
+        # taken between hands, when every card is in the deck or discards
+        return (self.deck.snapshot(), tuple(self.delays), self.delayed)
+
+    def restore(self, snapshot):
+        deck, delays, self.delayed = snapshot
+        self.deck.restore(deck)
+        self.delays[:] = delays
 
     def averageSpendTest(self, hands=20):
         results = {}
@@ -751,7 +1548,8 @@ class HumanPlayer(Player):
         self.hand = None
 
     def startHand(self):
-        self.hand = Hand(self.deck)
+        # dealt without the hand's trace, as GameCmd shows the human their hand itself
+        self.hand = Hand(cards=self.deck.deal(5))
 
     def buy(self, cardName):
         if not cardName in CARDS:
@@ -806,42 +1604,707 @@ class HumanPlayer(Player):
             self.hand.finish(self.deck)
             self.hand = None
 
-MAX_HANDS = 100
+class BuyPolicyTest(UntracedTest):
+    def test_sameChoiceAsComparingEveryCard(self):
+        rng = random.Random(1)
+        for i in range(200):
+            cards = rng.sample(CARD_NAMES, rng.randint(1, NUM_CARDS))
+            chrome = dict((c, (rng.randint(0, 3), rng.choice([0, 0, 1, 2]))) for c in cards)
+            table = Table(dict((c, rng.randint(0, 2)) for c in DEFAULT_STACKS))
+            player = Player(table, chrome)
+            player.deck = Deck(dict((c, rng.randint(0, 3)) for c in CARD_NAMES))
+            delays = list(player.delays)
+            for j in range(3):
+                # walk every card in the chromosome, as buying used to
+                cash = rng.randint(1, 10)
+                bestCards = []
+                for c in player.buyOrder:
+                    if CARD_COST[c] > cash or table.stacks[c] == 0: continue
+                    if delays[c] > 0:
+                        delays[c] -= 1
+                        continue
+                    key = (player.prefs[c], -player.deck.cards[c])
+                    if not bestCards or key > bestKey:
+                        bestCards = [c]
+                        bestKey = key
+                    elif key == bestKey:
+                        bestCards.append(c)
+                expected = CARD_NAMES[random.Random(i).choice(bestCards)] if bestCards else None
+                player.rng = random.Random(i)
+                self.assertEqual(player.playBuys(Hand(cards=['copper'] * cash)), expected)
+                self.assertEqual(player.delays, delays)
 
-def playGame(chromes, firstPlayer=0):
-    table = Table()
-    players = []
-    for chrome in chromes:
-        players.append(Player(table, chrome))
-
-    hands = 0
-    while not table.isGameEnd() and hands < MAX_HANDS:
-        p = (hands + firstPlayer) % len(players)
-        players[p].playHand()
-        hands += 1
+MAX_HANDS = 100
 
-    if not table.isGameEnd():
+class Game:
+    # a game between chromosomes, which can be snapshotted between hands and restored to play on differently
+    def __init__(self, chromes, firstPlayer=0, seed=None):
+        # every game has a generator of its own, so a seeded game plays out the same way in any process,
+        # and an unseeded one takes its seed from the main generator
+        if seed is None:
+            seed = gameSeed()
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.table = Table()
+        self.players = [Player(self.table, chrome, self.rng) for chrome in chromes]
+        self.firstPlayer = firstPlayer
+        self.hands = 0
+
+    def isOver(self):
+        return self.table.isGameEnd() or self.hands >= MAX_HANDS
+
+    def playHand(self):
+        self.players[(self.hands + self.firstPlayer) % len(self.players)].playHand()
+        self.hands += 1
+
+    def play(self):
+        while not self.isOver():
+            self.playHand()
+
+    def snapshot(self):
+        # everything which decides how the game plays on, as tuples which share the card names
+        return (self.hands, self.table.snapshot(), tuple(p.snapshot() for p in self.players), self.rng.getstate())
+
+    def restore(self, snapshot):
+        self.hands, table, players, rng = snapshot
+        self.table.restore(table)
+        for player, state in zip(self.players, players):
+            player.restore(state)
+        self.rng.setstate(rng)
+
+class GameTest(UntracedTest):
+    def test_restoredGamePlaysOnTheSame(self):
+        game = Game([FITTEST_SO_FAR, GOLD_N_NOBLES], seed=1)
+        for i in range(10):
+            game.playHand()
+        snapshot = game.snapshot()
+        game.play()
+        end = game.snapshot()
+        for i in range(3):
+            game.restore(snapshot)
+            self.assertEqual(game.hands, 10)
+            game.play()
+            self.assertEqual(game.snapshot(), end)
+
+    def test_branchesDiffer(self):
+        game = Game([FITTEST_SO_FAR, GOLD_N_NOBLES], seed=1)
+        snapshot = game.snapshot()
+        ends = set()
+        for seed in range(5):
+            game.restore(snapshot)
+            game.rng.seed(seed)
+            game.play()
+            ends.add(game.snapshot())
+            game.players[0].deck.checkTotals()
+        self.assertTrue(len(ends) > 1)
+
+def playGame(chromes, firstPlayer=0, seed=None, writer=None):
+    game = Game(chromes, firstPlayer, seed)
+    table = game.table
+    players = game.players
+    turns = [] if writer is not None else None
+    for player in players:
+        player.turns = turns
+
+    if PROFILE: start = time.time()
+    game.play()
+    hands = game.hands
+
+    if PROFILE:
+        PROFILE.addTime('games', start)
+        PROFILE.count('games')
+        PROFILE.count('hands', hands)
+        if not table.isGameEnd(): PROFILE.count('timeouts')
+    if TRACE and not table.isGameEnd():
         log('game', 'Game timed out after %s hands', hands)
 
     score0 = players[0].deck.countVictory()
     score1 = players[1].deck.countVictory()
+    if writer is not None:
+        writer.write(GameRecord(game.seed, firstPlayer, chromes, turns, (score0, score1)))
     if score0 == score1:
-        log('game', 'Draw after %s hands', hands)
+        if TRACE: log('game', 'Draw after %s hands', hands)
         return -1
     elif score0 > score1:
-        log('game', 'Player 0 won after %s hands', hands)
+        if TRACE: log('game', 'Player 0 won after %s hands', hands)
         return 0
     else:
-        log('game', 'Player 1 won after %s hands', hands)
+        if TRACE: log('game', 'Player 1 won after %s hands', hands)
         return 1
 
-def bestOf(chromes, games=500):
+class ProfileTest(UntracedTest):
+    def tearDown(self):
+        setProfiling(None)
+        UntracedTest.tearDown(self)
+
+    def test_profileGame(self):
+        profile = Profile()
+        setProfiling(profile)
+        playGame([FITTEST_SO_FAR, GOLD_N_NOBLES], seed=1)
+        self.assertEqual(profile.counts['games'], 1)
+        for name in ['hands', 'hand clones', 'candidate hands', 'shuffles']:
+            self.assertTrue(profile.counts[name] > 0, name)
+        self.assertTrue(profile.times['games'] >= profile.times['action search'] + profile.times['buy decisions'])
+
+class TracingTest(unittest.TestCase):
+    class CountingHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = 0
+            self.messages = []
+
+        def emit(self, record):
+            self.records += 1
+            self.messages.append(record.getMessage())
+
+    def setUp(self):
+        # count records instead of printing them
+        self.handler = TracingTest.CountingHandler()
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers
+        self.root.handlers = [self.handler]
+
+    def tearDown(self):
+        self.root.handlers = self.handlers
+        setTracing(True)
+
+    def test_noLoggingWithoutTracing(self):
+        setTracing(False)
+        playGame([FITTEST_SO_FAR, GOLD_N_NOBLES], seed=1)
+        self.assertEqual(self.handler.records, 0)
+
+    def test_loggingWithTracing(self):
+        setTracing(True)
+        playGame([FITTEST_SO_FAR, GOLD_N_NOBLES], seed=1)
+        self.assertTrue(self.handler.records > 0)
+
+    def test_humanHandShownWithoutTracing(self):
+        setTracing(False)
+        output = StringIO.StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            game = GameCmd(stdin=StringIO.StringIO('quit\n'), stdout=output)
+            game.use_rawinput = False
+            game.start(GOLD_N_NOBLES)
+        finally:
+            sys.stdout = stdout
+        self.assertTrue('Hand: %s' % game.human.hand.hand in output.getvalue())
+
+    def test_humanHandShownOnceWithTracing(self):
+        setTracing(True)
+        output = StringIO.StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            game = GameCmd(stdin=StringIO.StringIO('quit\n'), stdout=output)
+            game.use_rawinput = False
+            game.start(GOLD_N_NOBLES)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output.getvalue().count('Hand: %s' % game.human.hand.hand), 1)
+        # only the computer's hand is traced
+        self.assertEqual(len([m for m in self.handler.messages if m.startswith('Dealt hand')]), 1)
+
+    def test_learnLogsWithTracing(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            learn(trace=True, population=2, generations=1, errorRate=0.05)
+        finally:
+            sys.stdout = stdout
+        self.assertTrue([m for m in self.handler.messages if m.startswith('Dealt hand')])
+        self.assertTrue([m for m in self.handler.messages if m.startswith('Buying')])
+
+RECORD_MAGIC = 'DOMG\x01'
+# seed, first player, both scores and the number of turns
+RECORD_HEADER = struct.Struct('<IBhhH')
+# card id, preference and delay
+RECORD_CHROME_ENTRY = struct.Struct('<Bhh')
+# number of cards dealt, played and bought
+RECORD_TURN = struct.Struct('<BBB')
+RECORD_LENGTH = struct.Struct('<I')
+
+class GameRecord:
+    # a played game: enough to replay it (seed, first player, chromosomes), and what happened on each turn
+    # as (dealt, played, bought) lists of card ids, turns alternating between the players from the first
+    def __init__(self, seed, firstPlayer, chromes, turns, scores):
+        self.seed = seed
+        self.firstPlayer = firstPlayer
+        self.chromes = chromes
+        self.turns = turns
+        self.scores = scores
+
+    def __eq__(self, other):
+        return self.seed == other.seed and self.firstPlayer == other.firstPlayer and \
+            [c.items() for c in self.chromes] == [c.items() for c in other.chromes] and \
+            self.turns == other.turns and tuple(self.scores) == tuple(other.scores)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def result(self):
+        # the winner, or -1 for a draw, as playGame returns
+        score0, score1 = self.scores
+        return -1 if score0 == score1 else 0 if score0 > score1 else 1
+
+    def encode(self):
+        parts = [RECORD_HEADER.pack(self.seed, self.firstPlayer, self.scores[0], self.scores[1], len(self.turns))]
+        for chrome in self.chromes:
+            parts.append(chr(len(chrome)))
+            for card, (pref, delay) in chrome.items():
+                parts.append(RECORD_CHROME_ENTRY.pack(CARD_IDS[card], pref, delay))
+        for dealt, played, bought in self.turns:
+            parts.append(RECORD_TURN.pack(len(dealt), len(played), len(bought)))
+            parts.append(array.array('B', dealt + played + bought).tostring())
+        body = ''.join(parts)
+        return RECORD_LENGTH.pack(len(body)) + body
+
+    @staticmethod
+    def decode(data, offset=0):
+        # returns the record at offset in data (a string or mmap), and the offset of the next one
+        length, = RECORD_LENGTH.unpack_from(data, offset)
+        offset += RECORD_LENGTH.size
+        end = offset + length
+        seed, firstPlayer, score0, score1, numTurns = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        chromes = []
+        for i in range(2):
+            entries = ord(data[offset])
+            offset += 1
+            # keep the recorded order, which decides ties between equally preferred cards
+            chrome = collections.OrderedDict()
+            for j in range(entries):
+                card, pref, delay = RECORD_CHROME_ENTRY.unpack_from(data, offset)
+                offset += RECORD_CHROME_ENTRY.size
+                chrome[CARD_NAMES[card]] = (pref, delay)
+            chromes.append(chrome)
+        turns = []
+        for i in range(numTurns):
+            dealt, played, bought = RECORD_TURN.unpack_from(data, offset)
+            offset += RECORD_TURN.size
+            cards = array.array('B', data[offset:offset + dealt + played + bought]).tolist()
+            offset += dealt + played + bought
+            turns.append((cards[:dealt], cards[dealt:dealt + played], cards[dealt + played:]))
+        assert offset == end, 'Game record length %s, expected %s' % (offset - end + length, length)
+        return GameRecord(seed, firstPlayer, chromes, turns, (score0, score1)), end
+
+class GameWriter:
+    # writes game records to a file as they are played, in bulk
+    def __init__(self, path, bufferSize=1 << 20):
+        self.file = open(path, 'wb')
+        self.file.write(RECORD_MAGIC)
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.buffered = 0
+        self.games = 0
+
+    def write(self, record):
+        data = record.encode()
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.games += 1
+        if self.buffered >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class GameRecords(list):
+    # keeps game records in memory, in place of a GameWriter
+    write = list.append
+
+def readGames(path):
+    # iterate over the games in a record file, which is memory-mapped rather than read in
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+                raise ValueError('%s is not a game record file' % path)
+            offset = len(RECORD_MAGIC)
+            while offset < len(data):
+                record, offset = GameRecord.decode(data, offset)
+                yield record
+        finally:
+            data.close()
+
+def replayGame(record):
+    # play a recorded game again, turn for turn (with tracing on, this logs it in full)
+    replayed = GameRecords()
+    playGame(record.chromes, record.firstPlayer, record.seed, replayed)
+    if replayed[0] != record:
+        raise ValueError('Game with seed %s did not replay the same way' % record.seed)
+    return replayed[0]
+
+def recordGames(path, chromes, games=100):
+    # play games between two chromosomes, taking turns to go first, and record them
+    with GameWriter(path) as writer:
+        for i in range(games):
+            playGame(chromes, i % 2, gameSeed(), writer)
+    print 'Recorded %s games to %s' % (games, path)
+
+def buyStats(path):
+    # how often each card is bought, and on which of the buyer's turns on average
+    bought = collections.defaultdict(int)
+    turnTotals = collections.defaultdict(int)
+    games = 0
+    for record in readGames(path):
+        games += 1
+        for i, (dealt, played, buys) in enumerate(record.turns):
+            for card in buys:
+                bought[card] += 1
+                turnTotals[card] += i // 2 + 1
+    print '%s games' % games
+    for card in sorted(bought, key=lambda card: -bought[card]):
+        print '%-16s %8.2f per game, on turn %.1f' % (CARD_NAMES[card], float(bought[card]) / games,
+            float(turnTotals[card]) / bought[card])
+
+class GameRecordTest(UntracedTest):
+    def setUp(self):
+        UntracedTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'games.dat')
+
+    def tearDown(self):
+        UntracedTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def test_recordAndReplay(self):
+        chromes = [FITTEST_SO_FAR, GOLD_N_NOBLES]
+        results = []
+        # a small buffer, so some games are flushed before the writer is closed
+        with GameWriter(self.path, bufferSize=1000) as writer:
+            for seed in range(3):
+                results.append(playGame(chromes, seed % 2, seed, writer))
+        records = list(readGames(self.path))
+        self.assertEqual([r.result() for r in records], results)
+        self.assertEqual(results, [playGame(chromes, seed % 2, seed) for seed in range(3)])
+        for record in records:
+            self.assertEqual(record.chromes[0].items(), FITTEST_SO_FAR.items())
+            self.assertTrue(record.turns[0][0])
+            self.assertEqual(replayGame(record), record)
+
+def batchSupported(card):
+    # the batch engine handles treasure and victory cards, plus actions which Player.playActions always plays:
+    # a single compiled effect which gives back the action it uses and adds cards, cash or further actions
+    i = CARD_IDS[card]
+    if not CARD_HAS_ACTION[i]:
+        return True
+    effects = CARD_EFFECTS[i]
+    if effects is None or len(effects) != 1:
+        return False
+    actions, buys, cash, draw, replace, drawIfNoActions = effects[0]
+    return actions >= 1 and not (buys or replace or drawIfNoActions) and (draw > 0 or actions > 1 or cash > 0)
+
+class BatchGames:
+    # a batch of independent two-player games, played in lockstep with numpy
+    #
+    # Every pile is held as a count vector per game. Drawing from a shuffled pile is the same as drawing
+    # uniformly from the cards left in it, so draws sample a card by count instead of storing an order.
+    def __init__(self, games, seed=None):
+        n = len(games)
+        self.n = n
+        self.rng = np.random.RandomState(seed)
+        self.cost = np.array(CARD_COST)
+        self.cash = np.array(CARD_CASH)
+        self.victory = np.array(CARD_VICTORY)
+        self.supply = np.array(Table().supply)
+        # cards whose action is played automatically, and what playing them does
+        self.actionIds = np.array([i for i in ACTION_IDS if batchSupported(CARD_NAMES[i])], dtype=int)
+        # each one's compiled (actions, buys, cash, draw, replace, draw if no actions) effect
+        effects = [CARD_EFFECTS[i][0] for i in self.actionIds]
+        self.actionDraw = np.array([effect[3] for effect in effects], dtype=int)
+        self.actionCash = np.array([effect[2] for effect in effects], dtype=int)
+
+        # the chromosomes in order of play: seat 0 takes the first hand of each game
+        self.firstPlayer = np.array([firstPlayer for chromes, firstPlayer in games], dtype=int)
+        self.prefs = np.zeros((2, n, NUM_CARDS), dtype=int)
+        self.delays = np.zeros((2, n, NUM_CARDS), dtype=int)
+        self.listed = np.zeros((2, n, NUM_CARDS), dtype=bool)
+        for g, (chromes, firstPlayer) in enumerate(games):
+            for seat in range(2):
+                chrome = chromes[(seat + firstPlayer) % 2]
+                for card in chrome:
+                    if not batchSupported(card):
+                        raise ValueError('The batch engine does not support %s' % card)
+                    i = CARD_IDS[card]
+                    self.prefs[seat, g, i], self.delays[seat, g, i] = chrome[card]
+                    self.listed[seat, g, i] = True
+
+        start = countVector({'copper': 7, 'estate': 3})
+        # all cards owned by each player, those waiting to be drawn, and those discarded
+        self.cards = np.tile(start, (2, n, 1))
+        self.drawPile = self.cards.copy()
+        self.discards = np.zeros((2, n, NUM_CARDS), dtype=int)
+        self.stacks = np.tile(countVector(DEFAULT_STACKS), (n, 1))
+        # the hand of the player whose turn it is, and the cards they have played
+        self.hand = np.zeros((n, NUM_CARDS), dtype=int)
+        self.played = np.zeros((n, NUM_CARDS), dtype=int)
+
+    def isGameEnd(self):
+        depleted = (self.stacks[:, self.supply] == 0).sum(1)
+        return (self.stacks[:, PROVINCE] == 0) | (depleted >= 2)
+
+    def draw(self, seat, wanted):
+        # draw one card into the hand for each game where wanted is set
+        drawPile = self.drawPile[seat]
+        discards = self.discards[seat]
+        sizes = drawPile.sum(1)
+        empty = wanted & (sizes == 0)
+        if empty.any():
+            # shuffle the discards to form a new deck
+            drawPile[empty] += discards[empty]
+            discards[empty] = 0
+            sizes = drawPile.sum(1)
+        rows = np.nonzero(wanted & (sizes > 0))[0]
+        if len(rows) == 0:
+            return
+        picks = (self.rng.random_sample(len(rows)) * sizes[rows]).astype(int)
+        cards = (np.cumsum(drawPile[rows], 1) > picks[:, None]).argmax(1)
+        drawPile[rows, cards] -= 1
+        self.hand[rows, cards] += 1
+
+    def playActions(self, seat):
+        cashOffset = np.zeros(self.n, dtype=int)
+        while True:
+            playing = self.hand[:, self.actionIds]
+            if not playing.any():
+                return cashOffset
+            self.hand[:, self.actionIds] -= playing
+            self.played[:, self.actionIds] += playing
+            cashOffset += playing.dot(self.actionCash)
+            draws = playing.dot(self.actionDraw)
+            for i in range(draws.max()):
+                self.draw(seat, draws > i)
+
+    def playBuys(self, seat, cash):
+        cards = self.cards[seat]
+        delays = self.delays[seat]
+        candidates = (cash > 0)[:, None] & self.listed[seat] & (self.cost <= cash[:, None]) & (self.stacks > 0)
+        # affordable cards which are delayed use up a turn of their delay instead
+        delayed = candidates & (delays > 0)
+        delays[delayed] -= 1
+        candidates &= ~delayed
+        rows = np.nonzero(candidates.any(1))[0]
+        if len(rows) == 0:
+            return
+        # prefer the highest preference, then the card we have fewer of, then choose randomly
+        score = self.prefs[seat][rows] * 1000.0 - cards[rows] + self.rng.random_sample((len(rows), NUM_CARDS)) * 0.5
+        score[~candidates[rows]] = -np.inf
+        bought = score.argmax(1)
+        self.stacks[rows, bought] -= 1
+        cards[rows, bought] += 1
+        self.discards[seat][rows, bought] += 1
+
+    def playHand(self, seat, active):
+        self.hand[:] = 0
+        self.played[:] = 0
+        for i in range(5):
+            self.draw(seat, active)
+        cashOffset = self.playActions(seat)
+        # count the cash after playing actions, so that it includes the cards they drew
+        cash = self.hand.dot(self.cash) + cashOffset
+        self.playBuys(seat, cash)
+        self.discards[seat] += self.hand + self.played
+
+    def play(self):
+        # returns the result of each game, as playGame does
+        done = np.zeros(self.n, dtype=bool)
+        for hands in range(MAX_HANDS):
+            done |= self.isGameEnd()
+            if done.all():
+                break
+            self.playHand(hands % 2, ~done)
+        scores = self.cards.dot(self.victory)
+        # convert the scores from order of play back to player numbers
+        firstScore = np.where(self.firstPlayer == 0, scores[0], scores[1])
+        secondScore = np.where(self.firstPlayer == 0, scores[1], scores[0])
+        results = np.where(firstScore > secondScore, 0, 1)
+        results[firstScore == secondScore] = -1
+        return [int(r) for r in results]
+
+def playBatch(games, seed=None):
+    # play a list of (chromes, firstPlayer) games with the batch engine, returning the result of each
+    if np is None:
+        raise RuntimeError('The batch engine requires numpy')
+    return BatchGames(games, seed).play()
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class BatchGamesTest(UntracedTest):
+    BIG_MONEY = {'silver': (1, 0), 'gold': (2, 0), 'province': (3, 0)}
+    # buys great-halls from the start, so that most games play actions which draw cards
+    GREAT_HALLS = {'silver': (1, 0), 'gold': (2, 0), 'province': (3, 0), 'great-hall': (1, 0)}
+
+    def test_supportedCards(self):
+        self.assertTrue(batchSupported('gold'))
+        self.assertTrue(batchSupported('great-hall'))
+        self.assertFalse(batchSupported('nobles'))
+        self.assertFalse(batchSupported('shanty-town'))
+
+    def test_sameWinRateAsPlayGame(self):
+        games = 3000
+        chromes = [BatchGamesTest.BIG_MONEY, BatchGamesTest.GREAT_HALLS]
+        results = playBatch([(chromes, i % 2) for i in range(games)], seed=1)
+        batchWins = results.count(0) / float(games)
+        results = [playGame(chromes, i % 2, seed=i) for i in range(games)]
+        wins = results.count(0) / float(games)
+        # the difference in win rates should be well within four standard errors
+        error = (2 * wins * (1 - wins) / games) ** 0.5
+        self.assertTrue(abs(batchWins - wins) < 4 * error, '%s vs %s' % (batchWins, wins))
+
+# number of games sent to a worker process at a time
+GAME_BATCH_SIZE = 50
+
+def playGames(games):
+    # play a batch of (chromes, firstPlayer, seed) games, returning the result of each
+    return [playGame(chromes, firstPlayer, seed) for chromes, firstPlayer, seed in games]
+
+def playWorkerGames(games):
+    # playGames in a worker process, also returning the hits and misses it made in the worker's own
+    # transposition table, so that the parent can count them
+    hits, misses = TRANSPOSITIONS.hits, TRANSPOSITIONS.misses
+    results = playGames(games)
+    return results, TRANSPOSITIONS.hits - hits, TRANSPOSITIONS.misses - misses
+
+class GamePool:
+    # worker processes for playing games, started when first needed and kept until closed, so that rounds
+    # of games played one after another do not each start processes of their own
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+
+    def map(self, fn, items):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool.map(fn, items)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def runGames(games, workers=1, pool=None):
+    # with a GamePool, games are played in its processes rather than in processes started for this call
+    if workers <= 1:
+        return playGames(games)
+    batches = [games[i:i + GAME_BATCH_SIZE] for i in range(0, len(games), GAME_BATCH_SIZE)]
+    if pool is None:
+        with GamePool(workers) as pool:
+            batchResults = pool.map(playWorkerGames, batches)
+    else:
+        batchResults = pool.map(playWorkerGames, batches)
+    for results, hits, misses in batchResults:
+        TRANSPOSITIONS.hits += hits
+        TRANSPOSITIONS.misses += misses
+    return [result for results, hits, misses in batchResults for result in results]
+
+def gameSeed():
+    # each game gets its own seed drawn from the main generator, so results do not depend on the worker count
+    return random.getrandbits(32)
+
+def bestOf(chromes, games=500, workers=1, errorRate=None, pool=None):
+    # with an error rate, stop as soon as the stronger chromosome is known to that error rate
+    if errorRate:
+        return playUntilDecided(chromes, games, errorRate, workers=workers, pool=pool)
     wins = [0, 0]
-    for i in range(games):
-        result = playGame(chromes, i % 2)
+    results = runGames([(chromes, i % 2, gameSeed()) for i in range(games)], workers, pool)
+    for result in results:
         if result >= 0:
             wins[result] += 1
     print wins
+    return wins
+
+class SequentialTest:
+    # sequential probability ratio test of whether player 0 wins more or less than half of the decisive games,
+    # telling apart win rates of 0.5 - margin and 0.5 + margin, wrong at most errorRate of the time
+    def __init__(self, errorRate=0.05, margin=0.05):
+        low = 0.5 - margin
+        high = 0.5 + margin
+        # change in the log likelihood ratio for each win and each loss
+        self.winWeight = math.log(high / low)
+        self.lossWeight = math.log((1 - high) / (1 - low))
+        self.threshold = math.log((1 - errorRate) / errorRate)
+
+    def decide(self, wins):
+        # the stronger player, or None if more games are needed
+        ratio = wins[0] * self.winWeight + wins[1] * self.lossWeight
+        if ratio >= self.threshold:
+            return 0
+        elif ratio <= -self.threshold:
+            return 1
+        return None
+
+def winRateInterval(wins, z=1.96):
+    # Wilson score interval for player 0's chance of winning a decisive game
+    n = wins[0] + wins[1]
+    if n == 0:
+        return (0.0, 1.0)
+    p = float(wins[0]) / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    spread = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return (centre - spread, centre + spread)
+
+def playUntilDecided(chromes, games=500, errorRate=0.05, margin=0.05, workers=1, pool=None):
+    # play rounds of games until a sequential test settles which chromosome is stronger, or games run out
+    if pool is None:
+        # all the rounds are played in the same processes
+        with GamePool(workers) as pool:
+            return playUntilDecided(chromes, games, errorRate, margin, workers, pool)
+    test = SequentialTest(errorRate, margin)
+    roundSize = GAME_BATCH_SIZE * max(workers, 1)
+    wins = [0, 0]
+    played = 0
+    winner = None
+    while played < games and winner is None:
+        count = min(roundSize, games - played)
+        results = runGames([(chromes, (played + i) % 2, gameSeed()) for i in range(count)], workers, pool)
+        for result in results:
+            if result >= 0:
+                wins[result] += 1
+        played += count
+        winner = test.decide(wins)
+    low, high = winRateInterval(wins)
+    print wins
+    if winner is None:
+        print 'Undecided after %s games' % played
+    else:
+        print 'Player %s is stronger, decided after %s games' % (winner, played)
+    print 'Player 0 wins %.1f%% of decisive games (95%% interval %.1f%%-%.1f%%)' % \
+        (100.0 * wins[0] / max(1, wins[0] + wins[1]), 100 * low, 100 * high)
+    return wins
+
+class SequentialTestTest(unittest.TestCase):
+    def test_decides(self):
+        test = SequentialTest(errorRate=0.05, margin=0.05)
+        self.assertEqual(test.decide([57, 3]), 0)
+        self.assertEqual(test.decide([3, 57]), 1)
+        self.assertEqual(test.decide([30, 30]), None)
+
+    def test_interval(self):
+        low, high = winRateInterval([50, 50])
+        self.assertAlmostEqual(low + high, 1.0)
+        self.assertTrue(low < 0.5 < high)
+        low, high = winRateInterval([480, 20])
+        self.assertTrue(0.9 < low < 0.96 < high)
 
 def randomChrome():
     chrome = {}
@@ -858,23 +2321,255 @@ def randomPopulation(size=20):
         chromes.append(randomChrome())
     return chromes
 
-def fightAll(chromes):
+GAMES_PER_PAIR = 5
+
+def canonicalChrome(chrome):
+    # a chromosome which buys exactly as this one does: preferences only matter in their order, so each is
+    # replaced by its rank (equal preferences sharing one), and cards which are not in the supply are dropped
+    listed = [card for card in chrome if card in DEFAULT_STACKS]
+    ranks = dict((pref, rank) for rank, pref in enumerate(sorted(set(chrome[card][0] for card in listed))))
+    return dict((card, (ranks[chrome[card][0]], chrome[card][1])) for card in listed)
+
+def chromeKey(chrome):
+    # hashable form of a chromosome, which is the same for chromosomes which behave the same
+    return tuple(sorted(canonicalChrome(chrome).items()))
+
+def evaluateDistinct(evaluate, chromes, results=None):
+    # evaluate each distinct behaviour once, giving its fitness to every chromosome which behaves that way
+    keys = [chromeKey(chrome) for chrome in chromes]
+    index = {}
+    distinct = []
+    for chrome, key in zip(chromes, keys):
+        if key not in index:
+            index[key] = len(distinct)
+            distinct.append(chrome)
+    if len(distinct) == 1:
+        # nothing to play against, so all are equally fit
+        return [1] * len(chromes)
+    wins = evaluate(distinct, results)
+    return [wins[index[key]] for key in keys]
+
+class CanonicalChromeTest(UntracedTest):
+    def test_sameBehaviourSameKey(self):
+        scaled = dict((card, (pref * 3 + 1, delay)) for card, (pref, delay) in FITTEST_SO_FAR.items())
+        self.assertEqual(chromeKey(scaled), chromeKey(FITTEST_SO_FAR))
+        self.assertNotEqual(chromeKey(dict(scaled, gold=(2, 0))), chromeKey(FITTEST_SO_FAR))
+        self.assertNotEqual(chromeKey(dict(scaled, gold=(19, 1))), chromeKey(FITTEST_SO_FAR))
+        records = GameRecords()
+        for chrome in [scaled, FITTEST_SO_FAR]:
+            playGame([chrome, GOLD_N_NOBLES], seed=1, writer=records)
+        self.assertEqual(records[0].turns, records[1].turns)
+
+    def test_duplicatesShareFitness(self):
+        evaluated = []
+        def evaluate(chromes, results):
+            evaluated.append(len(chromes))
+            return range(len(chromes))
+        scaled = dict((card, (pref * 2, delay)) for card, (pref, delay) in GOLD_N_NOBLES.items())
+        wins = evaluateDistinct(evaluate, [FITTEST_SO_FAR, GOLD_N_NOBLES, dict(FITTEST_SO_FAR), scaled])
+        self.assertEqual(evaluated, [2])
+        self.assertEqual(wins, [0, 1, 0, 1])
+        self.assertEqual(evaluateDistinct(evaluate, [GOLD_N_NOBLES, scaled]), [1, 1])
+
+    def test_sweepingBehaviourStillBreeds(self):
+        # copies of a beaten behaviour do not play each other, so the winner is the only one with any wins
+        weak = {'estate': (1, 0), 'copper': (0, 0)}
+        chromes = [FITTEST_SO_FAR, weak, dict(weak), dict(weak)]
+        wins = evaluateDistinct(lambda chromes, results: [10, 0], chromes)
+        self.assertEqual(wins, [10, 0, 0, 0])
+        random.seed(1)
+        self.assertEqual(len(nextGeneration(chromes, wins)), 4)
+        self.assertEqual(len(nextGeneration(chromes, [0, 0, 0, 0])), 4)
+
+class MatchupResults(LRUCache):
+    # results of games between two chromosomes, as [player 0 wins, draws, player 1 wins], keyed by both
+    # chromosomes in seat order and the player who went first
+    def __init__(self, size=10000):
+        LRUCache.__init__(self, size)
+
+    def counts(self, chromes, firstPlayer=0):
+        key = (chromeKey(chromes[0]), chromeKey(chromes[1]), firstPlayer)
+        counts = self.get(key)
+        if counts is None:
+            counts = [0, 0, 0]
+            self.put(key, counts)
+        return counts
+
+    def dump(self):
+        # the stored results as JSON-friendly lists, least recently used first
+        return [[chrome1, chrome2, firstPlayer, counts]
+            for (chrome1, chrome2, firstPlayer), counts in self.entries.items()]
+
+    def load(self, data):
+        for chrome1, chrome2, firstPlayer, counts in data:
+            self.put((chromeKey(loadChrome(dict(chrome1))), chromeKey(loadChrome(dict(chrome2))), firstPlayer), counts)
+
+def fightAll(chromes, workers=1, results=None, pool=None):
+    # with a MatchupResults, pairs which have already played are not played again, only topped up
     wins = [0] * len(chromes)
+    pairs = []
+    counts = {}
+    for p1 in range(len(chromes)):
+        for p2 in range(len(chromes)):
+            if p1 == p2:
+                continue
+            pair = (p1, p2)
+            pairs.append(pair)
+            if results is None:
+                counts[pair] = [0, 0, 0]
+            else:
+                # identical pairs share their counts, so are only played once
+                counts[pair] = results.counts([chromes[p1], chromes[p2]])
+    # games already played for each distinct set of counts
+    played = dict((id(c), sum(c)) for c in counts.values())
+    owners = []
+    games = []
     # best of 5, both ways
-    for i in range(5):
-        for p1 in range(len(chromes)):
-            for p2 in range(len(chromes)):
-                if p1 == p2:
-                    continue
-                c1 = chromes[p1]
-                c2 = chromes[p2]
-                result = playGame([c1, c2])
-                if result == 0:
-                    wins[p1] += 1
-                elif result == 1:
-                    wins[p2] += 1
+    for i in range(GAMES_PER_PAIR):
+        for pair in pairs:
+            c = counts[pair]
+            if played[id(c)] > i:
+                continue
+            played[id(c)] = i + 1
+            owners.append(c)
+            games.append(([chromes[pair[0]], chromes[pair[1]]], 0, gameSeed()))
+    for c, result in zip(owners, runGames(games, workers, pool)):
+        if result == 0:
+            c[0] += 1
+        elif result == 1:
+            c[2] += 1
+        else:
+            c[1] += 1
+    for p1, p2 in pairs:
+        wins[p1] += counts[(p1, p2)][0]
+        wins[p2] += counts[(p1, p2)][2]
     return wins
 
+class FightAllTest(UntracedTest):
+    def test_sameWinsForAnyWorkerCount(self):
+        chromes = [FITTEST_SO_FAR, GOLD_N_NOBLES, GOLD_N_NOBLES]
+        random.seed(1)
+        serial = fightAll(chromes)
+        random.seed(1)
+        parallel = fightAll(chromes, workers=2)
+        self.assertEqual(serial, parallel)
+
+    def test_workerLookupsAreCounted(self):
+        TRANSPOSITIONS.clear()
+        fightAll([FITTEST_SO_FAR, GOLD_N_NOBLES], workers=2)
+        # every search was made in a worker process
+        self.assertEqual(len(TRANSPOSITIONS.entries), 0)
+        self.assertTrue(TRANSPOSITIONS.hits + TRANSPOSITIONS.misses > 0)
+
+    def test_seededGameIsRepeatable(self):
+        chromes = [FITTEST_SO_FAR, GOLD_N_NOBLES]
+        results = [playGame(chromes, seed=s) for s in range(5)]
+        self.assertEqual(results, [playGame(chromes, seed=s) for s in range(5)])
+
+    def test_storedResultsAreReused(self):
+        results = MatchupResults()
+        chromes = [FITTEST_SO_FAR, GOLD_N_NOBLES, dict(GOLD_N_NOBLES)]
+        random.seed(1)
+        wins = fightAll(chromes, results=results)
+        # the two copies of GOLD_N_NOBLES share their results, so each distinct pairing is played once
+        self.assertEqual(len(results.entries), 3)
+        self.assertEqual([sum(c) for c in results.entries.values()], [5, 5, 5])
+        state = random.getstate()
+        self.assertEqual(fightAll(chromes, results=results), wins)
+        # no games were played, so no seeds were drawn
+        self.assertEqual(random.getstate(), state)
+
+ELO_START = 1500
+ELO_K = 32
+SWISS_ROUNDS = 20
+
+def eloExpected(rating, other):
+    # expected score (1 for a win, 0.5 for a draw) against a player with the other rating
+    return 1 / (1 + 10 ** ((other - rating) / 400.0))
+
+def swissTournament(chromes, workers=1, results=None, rounds=SWISS_ROUNDS, pool=None):
+    # each round pairs chromosomes with similar Elo ratings for one game, so every chromosome plays `rounds`
+    # games whatever the size of the population (with an odd population, less its share of the byes);
+    # results are not stored, since each round depends on the last
+    if pool is None:
+        # all the rounds are played in the same processes
+        with GamePool(workers) as pool:
+            return swissTournament(chromes, workers, results, rounds, pool)
+    ratings = [ELO_START] * len(chromes)
+    order = range(len(chromes))
+    # number of times each pair has met
+    met = collections.defaultdict(int)
+    # number of rounds each chromosome has sat out
+    byes = [0] * len(chromes)
+    for r in range(rounds):
+        # sort by rating, breaking ties at random
+        random.shuffle(order)
+        order.sort(key=lambda i: -ratings[i])
+        pairs = swissPairs(order, met, byes)
+        for p1, p2 in pairs:
+            met[min(p1, p2), max(p1, p2)] += 1
+        games = [([chromes[p1], chromes[p2]], r % 2, gameSeed()) for p1, p2 in pairs]
+        for (p1, p2), result in zip(pairs, runGames(games, workers, pool)):
+            score = 1.0 if result == 0 else 0.0 if result == 1 else 0.5
+            change = ELO_K * (score - eloExpected(ratings[p1], ratings[p2]))
+            ratings[p1] += change
+            ratings[p2] -= change
+    # fitness is the percentage score expected against an average chromosome
+    mean = sum(ratings) / len(ratings)
+    return [int(round(100 * eloExpected(rating, mean))) for rating in ratings]
+
+def swissPairs(order, met, byes):
+    # pair each unpaired chromosome, best rated first, with the closest rated one it has met least often;
+    # with an odd population the lowest rated of those which have sat out least often sits out
+    unpaired = list(order)
+    if len(unpaired) % 2:
+        bye = min(reversed(unpaired), key=lambda p: byes[p])
+        unpaired.remove(bye)
+        byes[bye] += 1
+    pairs = []
+    while len(unpaired) > 1:
+        p1 = unpaired.pop(0)
+        p2 = min(unpaired, key=lambda p: met[min(p1, p), max(p1, p)])
+        unpaired.remove(p2)
+        pairs.append((p1, p2))
+    return pairs
+
+class SwissTournamentTest(UntracedTest):
+    def test_fitness(self):
+        random.seed(1)
+        weak = {'estate': (1, 0), 'copper': (0, 0)}
+        chromes = [weak, GOLD_N_NOBLES, dict(weak), FITTEST_SO_FAR, dict(weak)]
+        fitness = swissTournament(chromes, rounds=6)
+        self.assertEqual(len(fitness), 5)
+        self.assertTrue(min(fitness[1], fitness[3]) > max(fitness[0], fitness[2], fitness[4]))
+
+    def test_byesAreShared(self):
+        met = collections.defaultdict(int)
+        byes = [0] * 7
+        games = [0] * 7
+        for r in range(20):
+            for pair in swissPairs(range(7), met, byes):
+                for p in pair:
+                    games[p] += 1
+        self.assertEqual(sorted(set(games)), [17, 18])
+        self.assertEqual([20 - g for g in games], byes)
+
+    def test_roundsShareOnePool(self):
+        chromes = [GOLD_N_NOBLES, FITTEST_SO_FAR, dict(GOLD_N_NOBLES)]
+        random.seed(1)
+        serial = swissTournament(chromes, rounds=4)
+        random.seed(1)
+        with GamePool(2) as pool:
+            self.assertEqual(swissTournament(chromes, 2, rounds=4, pool=pool), serial)
+            started = pool.pool
+            fightAll(chromes, 2, pool=pool)
+            self.assertTrue(pool.pool is started)
+
+SCHEDULERS = {
+    'round-robin': fightAll,
+    'swiss': swissTournament,
+}
+
 def breed(parent1, parent2):
     child = {}
     for card in CARDS:
@@ -887,6 +2582,10 @@ def breed(parent1, parent2):
     return child
 
 def nextGeneration(chromes, wins):
+    if len([w for w in wins if w > 0]) < 2:
+        # two different parents are needed, so when one behaviour has beaten the rest (or none has won at all)
+        # every chromosome gets an extra chance of being chosen
+        wins = [w + 1 for w in wins]
     sampleSpace = []
     nextGen = []
     for i in range(len(chromes)):
@@ -930,11 +2629,154 @@ def fittest(chromes, wins):
             fittest = chromes[i]
     return fittest
 
+LOOKAHEAD_BUDGET = 0.2
+# standard errors by which a move must beat the chromosome's choice
+LOOKAHEAD_MARGIN = 2
+
+class LookaheadPlayer(Player):
+    # plays actions as Player does, but chooses what to buy by playing the rest of the game out many times
+    # after each choice, with both players following their chromosomes, until the time budget runs out
+    #
+    # The cards still to be drawn are shuffled for each rollout, since their order is not known to a player.
+    # Rollouts play on copies of the table and players, restored from a snapshot before each one.
+    def __init__(self, table, cardPrefs, rng=random, budget=LOOKAHEAD_BUDGET, opponentPrefs=None):
+        Player.__init__(self, table, cardPrefs, rng)
+        # seconds to spend on each buy
+        self.budget = budget
+        # the other player, and the chromosome their rollouts follow
+        self.opponent = None
+        self.opponentPrefs = opponentPrefs or cardPrefs
+        # (move, total score, rollouts) for each move weighed by the last lookahead
+        self.rollouts = []
+
+    def playBuys(self, hand):
+        cash = hand.countCash()
+        if cash == 0: return
+        deadline = time.time() + self.budget
+        if TRACE: log('buy', 'Cash: %s', cash)
+        bestCards = self.bestCards(cash)
+        # the chromosome's choice comes first, so it is kept unless the rollouts find something better
+        default = CARD_NAMES[self.rng.choice(bestCards)] if bestCards else None
+        moves = [default] + [c for c in self.cardPrefs
+            if c != default and CARDS[c].cost <= cash and self.table.count(c) > 0]
+        if default:
+            moves.append(None)
+        c = self.lookahead(hand, moves, deadline)
+        if c:
+            return self.buyCard(hand, c)
+        elif TRACE:
+            log('buy', 'No buy')
+
+    def lookahead(self, hand, moves, deadline):
+        # the move which the most rollouts went to, each rollout going to the move with the best upper
+        # confidence bound on its average result (UCB1), until the deadline
+        if len(moves) == 1 or not self.opponent:
+            return moves[0]
+        trace = TRACE
+        setTracing(False)
+        try:
+            rng = random.Random(self.rng.getrandbits(32))
+            # both players on a copy of the table, restored to where they are now before each rollout
+            table = self.table.copy()
+            # the rollouts play by the chromosome alone
+            me = self.copy(table, rng)
+            them = Player(table, self.opponentPrefs, rng)
+            them.deck = self.opponent.deck.copy(rng)
+            players = [them, me]
+            start = (table.snapshot(), [player.snapshot() for player in players])
+            scores = [0.0] * len(moves)
+            counts = [0] * len(moves)
+            total = 0
+            while time.time() < deadline:
+                if total < len(moves):
+                    i = total
+                else:
+                    bound = lambda i: scores[i] / counts[i] + math.sqrt(2 * math.log(total) / counts[i])
+                    i = max(range(len(moves)), key=bound)
+                score = self.rollout(hand, moves[i], table, players, start, deadline)
+                if score is None:
+                    break
+                scores[i] += score
+                counts[i] += 1
+                total += 1
+        finally:
+            setTracing(trace)
+        self.rollouts = zip(moves, scores, counts)
+        if TRACE: log('lookahead', 'Rollouts: %s', ', '.join('%s %s/%s' % (move or 'nothing', score, count)
+            for move, score, count in self.rollouts))
+        # only move away from the chromosome's choice when another move is clearly better, as a few rollouts
+        # can favour any move by chance
+        best = max(range(len(moves)), key=lambda i: (counts[i], -i))
+        if best and counts[0] and counts[best]:
+            mean = scores[best] / counts[best]
+            default = scores[0] / counts[0]
+            if mean - default < LOOKAHEAD_MARGIN * math.sqrt(0.25 / counts[best] + 0.25 / counts[0]):
+                best = 0
+        return moves[best]
+
+    def rollout(self, hand, move, table, players, start, deadline):
+        # 1 for a win after making the move, 0.5 for a draw and 0 for a loss, or None if the deadline passes
+        table.restore(start[0])
+        for player, snapshot in zip(players, start[1]):
+            player.restore(snapshot)
+            player.rng.shuffle(player.deck.deck)
+        them, me = players
+        if move:
+            table.buy(move, me.deck)
+        hand.clone().finish(me.deck)
+
+        hands = 0
+        while not table.isGameEnd() and hands < MAX_HANDS:
+            if time.time() > deadline:
+                return None
+            players[hands % 2].playHand()
+            hands += 1
+        mine = me.deck.countVictory()
+        theirs = them.deck.countVictory()
+        return 1.0 if mine > theirs else 0.5 if mine == theirs else 0.0
+
+class LookaheadPlayerTest(UntracedTest):
+    def test_buysTheWinningCard(self):
+        # one province left, and the opponent can afford it next turn: only buying it now wins
+        table = Table(dict(DEFAULT_STACKS, province=1))
+        player = LookaheadPlayer(table, {'silver': (5, 0), 'province': (1, 0)}, random.Random(1), budget=0.05,
+            opponentPrefs={'province': (5, 0)})
+        opponent = Player(table, {'province': (5, 0)}, random.Random(2))
+        opponent.deck = Deck({'gold': 8, 'estate': 2}, random.Random(3))
+        player.opponent = opponent
+        start = time.time()
+        self.assertEqual(player.playBuys(Hand(cards=['gold', 'gold', 'silver'])), 'province')
+        # the rollouts stop at the deadline; the bound is generous, but far below playing them all out
+        self.assertTrue(time.time() - start < 2)
+        # every rollout which buys silver ends with the opponent taking the last province
+        silver = [(score, count) for move, score, count in player.rollouts if move == 'silver']
+        self.assertEqual(silver[0][0], 0)
+        self.assertTrue(silver[0][1] > 0)
+
+    def test_rolloutsPlayByTheChromosome(self):
+        player = LookaheadPlayer(Table(), {'silver': (5, 0), 'province': (1, 3)}, random.Random(1))
+        player.delays[CARD_IDS['province']] = 1
+        me = player.copy(player.table.copy(), random.Random(2))
+        self.assertTrue(me.__class__ is Player)
+        self.assertFalse(hasattr(me, 'budget'))
+        self.assertEqual((me.deck.snapshot(), me.delays, me.delayed), (player.deck.snapshot(), player.delays,
+            player.delayed))
+
+    def test_noOpponentFollowsChromosome(self):
+        table = Table()
+        player = LookaheadPlayer(table, {'silver': (5, 0), 'province': (1, 0)}, random.Random(1), budget=0.05)
+        self.assertEqual(player.playBuys(Hand(cards=['gold', 'gold', 'silver'])), 'silver')
+
 class GameCmd(cmd.Cmd):
-    def start(self, chrome):
+    def start(self, chrome, lookahead=None):
+        # with a lookahead budget in seconds, the computer plays out its buys before making them
         self.table = Table()
         self.human = HumanPlayer(self.table)
-        self.computer = Player(self.table, chrome)
+        if lookahead:
+            self.computer = LookaheadPlayer(self.table, chrome, budget=lookahead)
+            self.computer.opponent = self.human
+        else:
+            self.computer = Player(self.table, chrome)
 
         if not self.nextTurn():
             self.cmdloop()
@@ -945,12 +2787,17 @@ class GameCmd(cmd.Cmd):
             return True
 
         print '\nComputer:'
-        self.computer.playHand();
+        self.playComputer()
         if self.checkGameEnd():
             return True
 
         print '\nYou:'
         self.human.startHand();
+        # shown here rather than by the hand's trace, which --fast turns off
+        print 'Hand: %s ($%s total)' % (self.human.hand.hand, self.human.hand.countCash())
+
+    def playComputer(self):
+        self.computer.playHand()
 
     def checkGameEnd(self):
         if self.table.isGameEnd():
@@ -1029,42 +2876,681 @@ GOLD_N_NOBLES = {
     'province': (3,3)
 }
 
-def learn():
-    # random.seed(1)
+def computerTurn(args):
+    # play the computer's next hand in a worker process, from a snapshot of the table and the computer,
+    # returning the computer's snapshot and generator state afterwards and what it dealt, played and bought
+    chrome, stacks, snapshot, rngState = args
+    rng = random.Random()
+    table = Table()
+    table.restore(stacks)
+    computer = Player(table, chrome, rng)
+    computer.restore(snapshot)
+    rng.setstate(rngState)
+    computer.turns = []
+    computer.playHand()
+    return computer.snapshot(), rng.getstate(), computer.turns[0]
+
+class ServerGameCmd(GameCmd):
+    # a GameCmd for one session of the game server, reading and writing the session's streams
+    #
+    # The computer's turns are played in the server's worker pool. Its hand and the actions it plays do not
+    # depend on the human's turn, and what it buys only depends on which stacks are empty, so it starts on
+    # its next turn while the human is still thinking, and keeps the result if no stack has run out since.
+    def __init__(self, pool, stdin, stdout):
+        GameCmd.__init__(self, stdin=stdin, stdout=stdout)
+        self.use_rawinput = False
+        self.pool = pool
+        # the cards available when the next computer turn was started, and its pending result
+        self.speculation = None
+        self.hits = 0
+
+    def start(self, chrome, seed=None):
+        self.table = Table()
+        self.human = HumanPlayer(self.table)
+        # the computer has a generator of its own, so its turns do not depend on the human's
+        self.computer = Player(self.table, chrome, random.Random(seed))
+        if not self.nextTurn():
+            self.cmdloop()
+
+    def playComputer(self):
+        result = None
+        if self.speculation:
+            available, pending = self.speculation
+            if available == self.table.available:
+                result = pending.get()
+                self.hits += 1
+        if result is None:
+            result = self.pool.apply(computerTurn, [self.turnArgs()])
+        snapshot, rngState, (dealt, played, bought) = result
+        for c in bought:
+            self.table.buy(CARD_NAMES[c], self.computer.deck)
+        self.computer.restore(snapshot)
+        self.computer.rng.setstate(rngState)
+        print 'Dealt %s, played %s, bought %s' % ([CARD_NAMES[c] for c in dealt], [CARD_NAMES[c] for c in played],
+            [CARD_NAMES[c] for c in bought])
+        self.speculation = (frozenset(self.table.available), self.pool.apply_async(computerTurn, [self.turnArgs()]))
+
+    def turnArgs(self):
+        return (self.computer.cardPrefs, self.table.snapshot(), self.computer.snapshot(), self.computer.rng.getstate())
+
+    def do_EOF(self, arg):
+        return True
+
+class ThreadStream(object):
+    # stands in for sys.stdin or sys.stdout, passing everything to the stream set for the current thread,
+    # so that each session's prints and prompts go to its own connection
+    def __init__(self, default):
+        object.__setattr__(self, 'default', default)
+        object.__setattr__(self, 'local', threading.local())
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.default
 
-    logging.getLogger('hand').setLevel(logging.WARNING)
-    logging.getLogger('action').setLevel(logging.WARNING)
-    logging.getLogger('cash').setLevel(logging.WARNING)
-    logging.getLogger('buy').setLevel(logging.WARNING)
-    logging.getLogger('game').setLevel(logging.WARNING)
-    logging.getLogger('play').setLevel(logging.WARNING)
+    def __getattr__(self, name):
+        return getattr(self.stream(), name)
 
-    chromes = randomPopulation(10)
-    chromes[0] = FITTEST_SO_FAR
+    def __setattr__(self, name, value):
+        setattr(self.stream(), name, value)
 
-    for i in range(20):
-        wins = fightAll(chromes)
+class GameSession(SocketServer.StreamRequestHandler):
+    def handle(self):
+        sys.stdin.set(self.rfile)
+        sys.stdout.set(self.wfile)
+        try:
+            ServerGameCmd(self.server.pool, self.rfile, self.wfile).start(self.server.chrome)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            sys.stdin.set(None)
+            sys.stdout.set(None)
+
+class TCPGameServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class UnixGameServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serveGames(address, workers=1, chrome=FITTEST_SO_FAR):
+    # host games against the computer, one per connection, on a (host, port) or the path of a unix socket
+    setTracing(False)
+    # the pool is started before any session threads
+    pool = multiprocessing.Pool(max(1, workers))
+    if isinstance(address, str):
+        server = UnixGameServer(address, GameSession)
+    else:
+        server = TCPGameServer(address, GameSession)
+    server.pool = pool
+    server.chrome = chrome
+    sys.stdin = ThreadStream(sys.stdin)
+    sys.stdout = ThreadStream(sys.stdout)
+    print 'Serving games on %s' % (address,)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+
+class ServerGameCmdTest(UntracedTest):
+    def setUp(self):
+        UntracedTest.setUp(self)
+        self.pool = multiprocessing.Pool(1)
+        self.stdout = sys.stdout
+        sys.stdout = ThreadStream(sys.stdout)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.pool.terminate()
+        UntracedTest.tearDown(self)
+
+    def test_speculativeTurnsMatchPlayingLocally(self):
+        # the human never buys anything, so every computer turn after the first is speculated
+        output = StringIO.StringIO()
+        sys.stdout.set(output)
+        session = ServerGameCmd(self.pool, StringIO.StringIO('done\n' * MAX_HANDS), output)
+        session.start(FITTEST_SO_FAR, seed=1)
+        self.assertTrue(session.table.isGameEnd())
+
+        computer = Player(Table(), FITTEST_SO_FAR, random.Random(1))
+        while not computer.table.isGameEnd():
+            computer.playHand()
+        self.assertEqual(session.computer.snapshot(), computer.snapshot())
+        self.assertEqual(session.hits, output.getvalue().count('Dealt') - 1)
+        self.assertTrue(session.hits > 0)
+
+
+def loadChrome(data):
+    # a chromosome read back from JSON, which has unicode card names and lists for tuples
+    return dict((str(card), tuple(value)) for card, value in data.items())
+
+def saveCheckpoint(path, generation, chromes, results=None):
+    state = {
+        'generation': generation,
+        'chromes': chromes,
+        'random': random.getstate(),
+        'results': results.dump() if results else None,
+    }
+    # write a new file and rename it over the old one, so that a crash never leaves a partial checkpoint
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        gz = gzip.GzipFile(fileobj=f, mode='wb')
+        gz.write(json.dumps(state, separators=(',', ':')))
+        gz.close()
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+def loadCheckpoint(path, results=None):
+    # restores the random state and any stored matchup results, returning (generation, chromes), where
+    # chromes is the population still to be evaluated
+    gz = gzip.open(path, 'rb')
+    try:
+        state = json.loads(gz.read())
+    finally:
+        gz.close()
+    version, internal, gauss = state['random']
+    random.setstate((version, tuple(internal), gauss))
+    if results is not None and state['results']:
+        results.load(state['results'])
+    return state['generation'], [loadChrome(chrome) for chrome in state['chromes']]
+
+def logFittest(path, generation, chrome, fitness):
+    # append one JSON line per generation
+    with open(path, 'a') as f:
+        f.write(json.dumps({'generation': generation, 'fitness': fitness, 'fittest': chrome}, sort_keys=True) + '\n')
+
+def evolve(chromes, evaluate, generations=20, start=0, results=None, checkpoint=None, checkpointEvery=1,
+        fittestLog=None, migrate=None):
+    # run generations start to generations - 1, returning the last population with its fittest first;
+    # evaluate returns the fitness of each chromosome, and may use the results store, and migrate is
+    # given each new generation along with the one before it from fittest to least fit
+    for i in range(start, generations):
+        evaluated = chromes
+        wins = evaluate(chromes, results)
         f = fittest(chromes, wins)
         print 'Fittest: %s' % f
+        if fittestLog:
+            logFittest(fittestLog, i, f, max(wins))
         chromes = nextGeneration(chromes, wins)
         mutateGeneration(chromes, 0.2)
         # keep the fittest without breeding or mutation
         chromes[0] = f
+        if migrate:
+            migrate(i, chromes, [evaluated[j] for j in sorted(range(len(wins)), key=lambda j: -wins[j])])
+        if checkpoint and ((i + 1) % checkpointEvery == 0 or i + 1 == generations):
+            saveCheckpoint(checkpoint, i + 1, chromes, results)
+    return chromes
+
+class CheckpointTest(UntracedTest):
+    def setUp(self):
+        UntracedTest.setUp(self)
+        # evolve prints the fittest of every generation
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, 'checkpoint.json.gz')
+        self.evaluate = lambda chromes, results: fightAll(chromes, results=results)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        UntracedTest.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def test_resumeMatchesUninterruptedRun(self):
+        # mutation picks from every card, so the population is made of complete chromosomes, as in learn
+        random.seed(0)
+        chromes = [FITTEST_SO_FAR] + randomPopulation(2)
+        random.seed(1)
+        expected = evolve(list(chromes), self.evaluate, generations=2, results=MatchupResults())
+
+        random.seed(1)
+        evolve(list(chromes), self.evaluate, generations=1, results=MatchupResults(), checkpoint=self.checkpoint)
+        random.seed(2)
+        results = MatchupResults()
+        generation, resumed = loadCheckpoint(self.checkpoint, results)
+        self.assertEqual(generation, 1)
+        self.assertEqual(len(results.entries), 6)
+        self.assertEqual(evolve(resumed, self.evaluate, generations=2, start=generation, results=results), expected)
+
+ISLAND_PLAYOFF_ROUNDS = 10
+# seconds between checks that every island is still running, while waiting for their results
+ISLAND_POLL_INTERVAL = 1
+
+def ringTopology(island, islands):
+    return [(island + 1) % islands]
+
+def completeTopology(island, islands):
+    return [i for i in range(islands) if i != island]
+
+# the islands each island sends its migrants to
+TOPOLOGIES = {
+    'ring': ringTopology,
+    'complete': completeTopology,
+}
 
+def immigrate(chromes, arrivals):
+    # replace the end of a new generation with chromosomes from other islands, given as (island, chromes)
+    # pairs, in order of island so the result does not depend on which arrived first; the children there
+    # have not been played yet, so are no less fit than any others, but the fittest kept at the start is not
+    immigrants = [chrome for island, migrants in sorted(arrivals) for chrome in migrants]
+    # the fittest is always kept
+    immigrants = immigrants[:len(chromes) - 1]
+    if immigrants:
+        chromes[-len(immigrants):] = immigrants
+
+def receiveMigrants(inbox, generation, sources, pending):
+    # the (island, chromes) migrants sent to this island after the given generation, one from each source;
+    # those a faster island has already sent after a later generation are kept in pending until then
+    while len(pending[generation]) < sources:
+        sent, island, migrants = inbox.get()
+        pending[sent].append((island, migrants))
+    return pending.pop(generation)
+
+def runIsland(island, chromes, generations, migrateEvery, migrants, inbox, outboxes, sources, output, seed,
+        scheduler, rounds, cacheSize):
+    # evolve one island's population in its own process, sending its fittest chromosomes to other islands
+    # and taking theirs in every migrateEvery generations, then put its fittest on the output queue
+    random.seed(seed)
+    results = MatchupResults(cacheSize) if cacheSize else None
+    evaluate = SCHEDULERS[scheduler]
+    if evaluate is swissTournament:
+        evaluate = functools.partial(evaluate, rounds=rounds)
+
+    pending = collections.defaultdict(list)
+    def migrate(i, chromes, ranked):
+        if (i + 1) % migrateEvery or i + 1 == generations:
+            return
+        for outbox in outboxes:
+            outbox.put((i, island, ranked[:migrants]))
+        immigrate(chromes, receiveMigrants(inbox, i, sources, pending))
+
+    play = lambda chromes, results: evaluate(chromes, 1, results)
+    chromes = evolve(chromes, lambda chromes, results: evaluateDistinct(play, chromes, results), generations,
+        results=results, migrate=migrate)
+    output.put((island, chromes[0]))
+
+def evolveIslands(islands, population=10, generations=20, migrateEvery=5, migrants=2, topology='ring',
+        scheduler='round-robin', rounds=SWISS_ROUNDS, workers=1, cacheSize=10000, pool=None):
+    # evolve a population on each of several islands in parallel, with the fittest of each island migrating
+    # to others now and then, and return the fittest of each island, ordered by a playoff between them
+    if pool is None:
+        # the playoff rounds are played in the same processes
+        with GamePool(workers) as pool:
+            return evolveIslands(islands, population, generations, migrateEvery, migrants, topology, scheduler,
+                rounds, workers, cacheSize, pool)
+    inboxes = [multiprocessing.Queue() for i in range(islands)]
+    output = multiprocessing.Queue()
+    processes = []
+    for i in range(islands):
+        chromes = randomPopulation(population)
+        if i == 0:
+            chromes[0] = FITTEST_SO_FAR
+        destinations = TOPOLOGIES[topology](i, islands)
+        sources = len([j for j in range(islands) if i in TOPOLOGIES[topology](j, islands)])
+        process = multiprocessing.Process(target=runIsland, args=(i, chromes, generations, migrateEvery, migrants,
+            inboxes[i], [inboxes[d] for d in destinations], sources, output, random.getrandbits(32), scheduler,
+            rounds, cacheSize))
+        process.start()
+        processes.append(process)
+    # read the results before joining, as a process does not exit until its queued data is taken
+    champions = {}
+    while len(champions) < islands:
+        try:
+            island, champion = output.get(timeout=ISLAND_POLL_INTERVAL)
+            champions[island] = champion
+        except Queue.Empty:
+            # an island which has failed will never send its result, and others may be waiting for its migrants
+            failed = [i for i in range(islands) if processes[i].exitcode]
+            if failed:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                raise RuntimeError('Island %s failed with exit code %s' % (failed[0], processes[failed[0]].exitcode))
+    for process in processes:
+        process.join()
+    champions = [champions[i] for i in range(islands)]
+
+    wins = [0] * islands
+    for i in range(ISLAND_PLAYOFF_ROUNDS):
+        wins = [a + b for a, b in zip(wins, fightAll(champions, workers, pool=pool))]
+    print 'Playoff: %s' % wins
+    return [champions[i] for i in sorted(range(islands), key=lambda i: -wins[i])]
+
+class IslandTest(UntracedTest):
+    def setUp(self):
+        UntracedTest.setUp(self)
+        # each island prints the fittest of every generation, and the playoff its result
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        UntracedTest.tearDown(self)
+
+    def test_immigrantsReplaceNewChildrenButNotTheFittest(self):
+        chromes = ['a', 'b', 'c', 'd']
+        immigrate(chromes, [(2, ['y']), (1, ['x'])])
+        self.assertEqual(chromes, ['a', 'b', 'x', 'y'])
+        immigrate(chromes, [(1, ['p', 'q', 'r', 's'])])
+        self.assertEqual(chromes, ['a', 'p', 'q', 'r'])
+
+    def test_migrantsAreTakenInGenerationOrder(self):
+        inbox = Queue.Queue()
+        # island 2 has already sent its migrants for generation 5 before island 1 sent those for generation 4
+        inbox.put((4, 2, ['b']))
+        inbox.put((5, 2, ['d']))
+        inbox.put((4, 1, ['a']))
+        inbox.put((5, 1, ['c']))
+        pending = collections.defaultdict(list)
+        self.assertEqual(sorted(receiveMigrants(inbox, 4, 2, pending)), [(1, ['a']), (2, ['b'])])
+        self.assertEqual(sorted(receiveMigrants(inbox, 5, 2, pending)), [(1, ['c']), (2, ['d'])])
+
+    def test_failedIslandIsReported(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.assertRaises(RuntimeError, evolveIslands, 2, population=3, generations=1, scheduler='unknown')
+        finally:
+            sys.stderr = stderr
+
+    def test_islandsAreRepeatable(self):
+        random.seed(1)
+        first = evolveIslands(2, population=3, generations=2, migrateEvery=1, migrants=1)
+        random.seed(1)
+        second = evolveIslands(2, population=3, generations=2, migrateEvery=1, migrants=1)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(first, second)
+        # with the result cache turned off
+        self.assertEqual(len(evolveIslands(2, population=3, generations=2, migrateEvery=1, migrants=1, cacheSize=0)), 2)
+
+def learn(workers=1, trace=False, errorRate=None, cacheSize=10000, scheduler='round-robin',
+        population=10, rounds=SWISS_ROUNDS, generations=20, checkpoint=None, checkpointEvery=1, resume=None,
+        fittestLog=None, islands=1, migrateEvery=5, migrants=2, topology='ring'):
+    # random.seed(1)
+    setTracing(trace)
+
+    # every game of the run is played in the same worker processes
+    with GamePool(workers) as pool:
+        if islands > 1:
+            if checkpoint or resume or fittestLog:
+                raise ValueError('Checkpoints and the fittest log are not supported with islands')
+            chromes = evolveIslands(islands, population, generations, migrateEvery, migrants, topology, scheduler,
+                rounds, workers, cacheSize, pool)
+            finishLearning(chromes[0], workers, errorRate, pool)
+            return
+
+        # results of pairings seen in earlier generations
+        results = MatchupResults(cacheSize) if cacheSize else None
+        if resume:
+            start, chromes = loadCheckpoint(resume, results)
+            print 'Resuming from generation %s' % start
+            # carry on writing to the checkpoint we resumed from
+            checkpoint = checkpoint or resume
+        else:
+            start = 0
+            chromes = randomPopulation(population)
+            chromes[0] = FITTEST_SO_FAR
+        scheduler = SCHEDULERS[scheduler]
+        if scheduler is swissTournament:
+            scheduler = functools.partial(scheduler, rounds=rounds)
+        play = lambda chromes, results: scheduler(chromes, workers, results, pool=pool)
+        # chromosomes which behave the same are only played once
+        evaluate = lambda chromes, results: evaluateDistinct(play, chromes, results)
+
+        chromes = evolve(chromes, evaluate, generations, start, results, checkpoint, checkpointEvery, fittestLog)
+
+        lookups = TRANSPOSITIONS.hits + TRANSPOSITIONS.misses
+        if lookups and workers > 1:
+            # lookups are counted over all the workers, but each keeps a table of its own
+            print 'Transposition table: %s, over %s workers' % (TRANSPOSITIONS.describeLookups(), workers)
+        elif lookups:
+            print 'Transposition table: %s' % TRANSPOSITIONS.describe()
+        if results and scheduler is fightAll:
+            # the Swiss tournament does not store results, since each round depends on the last
+            print 'Matchup results: %s' % results.describe()
+        finishLearning(chromes[0], workers, errorRate, pool)
+
+def finishLearning(chrome, workers=1, errorRate=None, pool=None):
     print 'New fittest vs. previous:'
-    bestOf([chromes[0], FITTEST_SO_FAR])
+    bestOf([chrome, FITTEST_SO_FAR], workers=workers, errorRate=errorRate, pool=pool)
 
     print 'New fittest vs. simple human strategy:'
-    bestOf([chromes[0], GOLD_N_NOBLES])
+    bestOf([chrome, GOLD_N_NOBLES], workers=workers, errorRate=errorRate, pool=pool)
+
+# action-heavy hands for timing the action search
+BENCH_HANDS = [
+    ['pawn', 'pawn', 'pawn', 'great-hall', 'copper'],
+    ['shanty-town', 'shanty-town', 'nobles', 'pawn', 'estate'],
+    ['secret-chamber', 'courtyard', 'nobles', 'estate', 'estate', 'pawn', 'copper'],
+    ['pawn', 'pawn', 'shanty-town', 'nobles', 'secret-chamber', 'estate', 'pawn'],
+]
+BENCH_CHROMES = [FITTEST_SO_FAR, GOLD_N_NOBLES]
+# slowest allowed time for each benchmark, as a proportion of its baseline
+BENCH_THRESHOLD = 0.2
+
+def benchWaysToPlayHand():
+    TRANSPOSITIONS.clear()
+    for cards in BENCH_HANDS:
+        Hand(cards=list(cards)).waysToPlayHand()
+    return len(BENCH_HANDS)
+
+def benchHandSearch():
+    TRANSPOSITIONS.clear()
+    deck = Deck({'copper': 7, 'silver': 3, 'estate': 3})
+    for cards in BENCH_HANDS:
+        HandSearch(deck).search(Hand(cards=list(cards)))
+    return len(BENCH_HANDS)
+
+def benchPlayHand():
+    TRANSPOSITIONS.clear()
+    hands = 0
+    for seed in range(10):
+        player = Player(Table(), FITTEST_SO_FAR, random.Random(seed))
+        for i in range(20):
+            player.playHand()
+            hands += 1
+    return hands
+
+def benchPlayGame():
+    TRANSPOSITIONS.clear()
+    games = 50
+    for seed in range(games):
+        playGame(BENCH_CHROMES, seed % 2, seed)
+    return games
+
+def benchFightAll():
+    TRANSPOSITIONS.clear()
+    random.seed(1)
+    fightAll(BENCH_CHROMES + randomPopulation(3))
+    return 1
+
+# name, function and what one operation is; each function empties the transposition table first, so its
+# time does not depend on what ran before it
+BENCHMARKS = [
+    ('waysToPlayHand', benchWaysToPlayHand, 'hand'),
+    ('HandSearch', benchHandSearch, 'hand'),
+    ('playHand', benchPlayHand, 'turn'),
+    ('playGame', benchPlayGame, 'game'),
+    ('fightAll', benchFightAll, 'generation'),
+]
+
+def timeBenchmark(fn, repeat=3):
+    # best time per operation over several runs of fn, which returns the number of operations it performed
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        operations = fn()
+        elapsed = (time.time() - start) / operations
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def compareBenchmarks(times, baseline, threshold=BENCH_THRESHOLD):
+    # names of the benchmarks which are slower than their baseline by more than the threshold
+    return [name for name in sorted(times) if name in baseline and times[name] > baseline[name] * (1 + threshold)]
+
+def checkEngines(games=5000):
+    # the batch engine must give the same win rate as playGame, to within four standard errors
+    if np is None:
+        print 'Batch engine: skipped, numpy is not installed'
+        return True
+    chromes = [BatchGamesTest.BIG_MONEY, BatchGamesTest.GREAT_HALLS]
+    batchWins = playBatch([(chromes, i % 2) for i in range(games)], 1).count(0) / float(games)
+    wins = [playGame(chromes, i % 2, i) for i in range(games)].count(0) / float(games)
+    error = math.sqrt(2 * wins * (1 - wins) / games)
+    agree = abs(batchWins - wins) < 4 * error
+    print 'Batch engine: win rate %.3f vs %.3f for playGame (%s)' % (batchWins, wins, 'ok' if agree else 'DIFFERENT')
+    return agree
+
+def bench(baselineFile='bench-baseline.json', save=False, threshold=BENCH_THRESHOLD):
+    # time the simulation hot paths, and compare them with the baseline saved in baselineFile
+    trace = TRACE
+    setTracing(False)
+    try:
+        times = {}
+        for name, fn, operation in BENCHMARKS:
+            times[name] = timeBenchmark(fn)
+        agree = checkEngines()
+    finally:
+        setTracing(trace)
+
+    baseline = {}
+    if os.path.exists(baselineFile):
+        with open(baselineFile) as f:
+            baseline = json.load(f)['times']
+    for name, fn, operation in BENCHMARKS:
+        line = '%-16s %10.3f ms per %s' % (name, 1000 * times[name], operation)
+        if name in baseline:
+            line += ' (%+.1f%% vs. baseline)' % (100 * (times[name] / baseline[name] - 1))
+        print line
+    regressions = compareBenchmarks(times, baseline, threshold)
+    if regressions:
+        print 'Slower than baseline: %s' % ', '.join(regressions)
+
+    if save:
+        with open(baselineFile, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'times': times}, f, indent=2, sort_keys=True)
+        print 'Saved baseline to %s' % baselineFile
+    return agree and not regressions
+
+def describeChrome(chrome, cards=4):
+    # the most preferred cards of a chromosome
+    prefs = sorted(chrome, key=lambda card: -chrome[card][0])
+    return ' '.join(prefs[:cards])
+
+def profileGames(games=100, seed=1):
+    # play games between random chromosomes, as learn does, and print where the time goes
+    trace = TRACE
+    setTracing(False)
+    random.seed(seed)
+    total = Profile()
+    slowest = []
+    try:
+        for i in range(games):
+            chromes = randomPopulation(2)
+            profile = Profile()
+            setProfiling(profile)
+            playGame(chromes, i % 2, gameSeed())
+            setProfiling(None)
+            total.merge(profile)
+            slowest.append((profile.times['games'], profile.counts['hands'], chromes))
+    finally:
+        setProfiling(None)
+        setTracing(trace)
+
+    counts = total.counts
+    times = total.times
+    elapsed = times['games']
+    print 'Profiled %s games in %.2fs (%.1f ms per game)' % (games, elapsed, 1000 * elapsed / games)
+    for name in ['action search', 'buy decisions']:
+        print '  %-16s %6.1f%% of game time' % (name, 100 * times[name] / elapsed)
+    print '  %-16s %8.1f per game' % ('hands', float(counts['hands']) / games)
+    for name in ['candidate hands', 'hand clones', 'shuffles']:
+        print '  %-16s %8.1f per hand' % (name, float(counts[name]) / counts['hands'])
+    print '  %-16s %6s games' % ('timeouts', counts['timeouts'])
+    print 'Slowest games:'
+    slowest.sort(key=lambda game: -game[0])
+    for elapsed, hands, chromes in slowest[:5]:
+        print '  %6.1f ms, %3s hands: %s vs. %s' % (1000 * elapsed, hands, describeChrome(chromes[0]), describeChrome(chromes[1]))
+    return total
+
+class BenchTest(unittest.TestCase):
+    def test_compareBenchmarks(self):
+        baseline = {'a': 1.0, 'b': 1.0}
+        self.assertEqual(compareBenchmarks({'a': 1.1, 'b': 1.5, 'c': 9.0}, baseline, 0.2), ['b'])
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(usage='dominion.py play|learn|serve|bench|profile|record|stats|test [options]')
+    parser.add_argument('command', nargs='?', default='play')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of processes used to play games while learning')
+    parser.add_argument('--error-rate', dest='errorRate', type=float,
+        help='end the final comparisons once the stronger chromosome is known with this chance of being wrong')
+    parser.add_argument('--result-cache', dest='cacheSize', type=int, default=10000,
+        help='number of pairings whose results are kept between generations (0 to replay every pairing)')
+    parser.add_argument('--population', type=int, default=10, help='number of chromosomes in each generation')
+    parser.add_argument('--scheduler', choices=sorted(SCHEDULERS), default='round-robin',
+        help='how games are arranged to find the fitness of each generation')
+    parser.add_argument('--rounds', type=int, default=SWISS_ROUNDS,
+        help='games played by each chromosome per generation with the swiss scheduler')
+    parser.add_argument('--lookahead', type=int,
+        help='milliseconds the computer may spend playing out each buy before making it')
+    parser.add_argument('--islands', type=int, default=1,
+        help='number of populations to learn with in parallel processes, exchanging their fittest now and then')
+    parser.add_argument('--migrate-every', dest='migrateEvery', type=int, default=5,
+        help='number of generations between migrations between islands')
+    parser.add_argument('--migrants', type=int, default=2, help='number of chromosomes each island sends')
+    parser.add_argument('--topology', choices=sorted(TOPOLOGIES), default='ring',
+        help='which islands each island sends its migrants to')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to serve games on')
+    parser.add_argument('--socket', help='unix socket to serve games on, instead of a TCP port')
+    parser.add_argument('--generations', type=int, default=20, help='number of generations to learn for')
+    parser.add_argument('--checkpoint', help='file to save the population to as learning goes on')
+    parser.add_argument('--checkpoint-every', dest='checkpointEvery', type=int, default=1,
+        help='number of generations between checkpoints')
+    parser.add_argument('--resume', help='checkpoint file to carry on learning from')
+    parser.add_argument('--fittest-log', dest='fittestLog',
+        help='file to append the fittest chromosome of each generation to, as JSON lines')
+    parser.add_argument('--games', type=int, default=100, help='number of games to profile or record')
+    parser.add_argument('--record', default='games.dat', help='game record file to write or read')
+    parser.add_argument('--baseline', default='bench-baseline.json', help='benchmark baseline file')
+    parser.add_argument('--save', action='store_true', help='save the benchmark times as the new baseline')
+    parser.add_argument('--threshold', type=float, default=BENCH_THRESHOLD,
+        help='proportion by which a benchmark may be slower than its baseline')
+    tracing = parser.add_mutually_exclusive_group()
+    tracing.add_argument('--trace', dest='trace', action='store_true', default=None,
+        help='log every hand dealt, action played and card bought (default when playing)')
+    tracing.add_argument('--fast', dest='trace', action='store_false',
+        help='simulate without any logging (default when learning)')
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    command = sys.argv[1] if len(sys.argv) > 1 else 'play'
+    args = parseArgs(sys.argv[1:])
+    command = args.command
     if command == 'test':
         unittest.main(__name__, None, [sys.argv[0]])
     elif command == 'play':
-        GameCmd().start(FITTEST_SO_FAR)
+        setTracing(args.trace is not False)
+        GameCmd().start(FITTEST_SO_FAR, args.lookahead and args.lookahead / 1000.0)
     elif command == 'learn':
-        learn()
+        learn(args.workers, args.trace is True, args.errorRate, args.cacheSize, args.scheduler,
+            args.population, args.rounds, args.generations, args.checkpoint, args.checkpointEvery, args.resume,
+            args.fittestLog, args.islands, args.migrateEvery, args.migrants, args.topology)
+    elif command == 'serve':
+        serveGames(args.socket or ('localhost', args.port), args.workers)
+    elif command == 'bench':
+        if not bench(args.baseline, args.save, args.threshold):
+            sys.exit(1)
+    elif command == 'profile':
+        profileGames(args.games)
+    elif command == 'record':
+        setTracing(args.trace is True)
+        recordGames(args.record, BENCH_CHROMES, args.games)
+    elif command == 'stats':
+        buyStats(args.record)
     else:
         print 'Unknown command %s' % command
-        print 'Usage: dominion.py play|learn|test'
+        print 'Usage: dominion.py play|learn|serve|bench|profile|record|stats|test'